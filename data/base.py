@@ -2,7 +2,7 @@ import os
 
 import numpy as np
 from psycopg2.extensions import AsIs, register_adapter
-from sqlalchemy import create_engine
+from sqlalchemy import URL, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -12,7 +12,16 @@ host = os.getenv("POSTGRES_HOST")
 port = os.getenv("POSTGRES_PORT")
 database = os.getenv("POSTGRES_DB")
 
-conn_str = f"postgresql://{username}:{password}@{host}:{port}/{database}"
+# the engine connects on first use, so that modules like the offline recompute
+# can be imported without the PostgreSQL variables
+conn_str = URL.create(
+    "postgresql",
+    username=username,
+    password=password,
+    host=host,
+    port=int(port) if port else None,
+    database=database,
+)
 engine = create_engine(
     conn_str,
     pool_size=0,
@@ -0,0 +1,70 @@
+import io
+
+from sqlalchemy import Column, MetaData, Table, select
+from sqlalchemy.dialects.postgresql import insert
+
+# backslash escapes of the COPY text format
+ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _to_text(value):
+    if value is None:
+        return "\\N"
+    # bytea in hex format
+    if isinstance(value, bytes):
+        return f"\\\\x{value.hex()}"
+    return str(value).translate(ESCAPES)
+
+
+def _write_text(rows, columns):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_to_text(row[column]) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def bulk_insert(session, model, rows, index_elements, update=None, returning=None):
+    """Insert `rows` (a list of dicts) into the table of `model` with a single COPY
+    into a temporary staging table and a single `INSERT ... SELECT` from it.
+
+    Conflicting rows on `index_elements` are skipped, or have their `update`
+    columns overwritten. Returns the `returning` columns of the inserted or
+    updated rows. The caller owns the transaction and commits it.
+    """
+    if len(rows) == 0:
+        return []
+
+    table = model.__table__
+    columns = list(rows[0].keys())
+    staging = Table(
+        f"staging_{table.name}",
+        MetaData(),
+        *[Column(column, table.c[column].type) for column in columns],
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+
+    connection = session.connection()
+    staging.create(connection)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {staging.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT text)",
+            _write_text(rows, columns),
+        )
+
+    stmt = insert(model).from_select(columns, select(*staging.c))
+    if update is None:
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+    else:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update},
+        )
+    if returning is not None:
+        stmt = stmt.returning(*returning)
+    result = session.execute(stmt)
+    rows = result.all() if returning is not None else []
+    staging.drop(connection)
+    return rows
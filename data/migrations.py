@@ -0,0 +1,408 @@
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+from data.models import Price, Transfer
+from data.partitions import get_month
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - data/%(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+BATCH_SIZE = 50000  # rows rewritten per transaction by online migrations
+# opt-in to the migrations that delete data, like the transfers without a natural key
+RESET_TRANSFERS = os.getenv("RESET_TRANSFERS", "0") == "1"
+
+
+def _backfill(engine, table, key, assignments, join=""):
+    """Apply `assignments` to all rows of `table` in batches of BATCH_SIZE rows
+    along the primary key `key`, committing every batch."""
+    columns = ", ".join(key)
+    descending = ", ".join(f"{column} DESC" for column in key)
+    batch_key = ", ".join(f"batch.{column}" for column in key)
+    table_key = ", ".join(f"{table}.{column}" for column in key)
+    params = ", ".join(f":{column}" for column in key)
+    last = None
+    while True:
+        after = "" if last is None else f"WHERE ({columns}) > ({params})"
+        stmt = text(
+            f"WITH batch AS (SELECT {columns} FROM {table} {after}"
+            f" ORDER BY {columns} LIMIT {BATCH_SIZE}),"
+            f" updated AS (UPDATE {table} SET {assignments} FROM batch {join}"
+            f" WHERE ({table_key}) = ({batch_key}) RETURNING {table_key})"
+            f" SELECT * FROM updated ORDER BY {descending}"
+        )
+        with engine.begin() as connection:
+            rows = connection.execute(stmt, last or {}).all()
+        if len(rows) == 0:
+            return
+        logger.info(f"migrated {len(rows)} rows of {table}")
+        last = rows[0]._asdict()
+
+
+def _transfer_natural_key(engine):
+    """Replace the md5 ids of the transfers by (tx_hash, log_index, token_id).
+
+    The md5 ids cannot be mapped back to (tx_hash, log_index), so the transfers
+    are dropped and collected again by `check_transfers`, which also forces a
+    full recalculation of the CAR. As this deletes data, it only runs with
+    RESET_TRANSFERS=1, otherwise the migration fails and is retried on the next
+    start."""
+    with engine.connect() as connection:
+        legacy = connection.execute(
+            text(
+                "SELECT FROM information_schema.columns"
+                " WHERE table_name = 'transfers' AND column_name = 'id'"
+            )
+        ).first()
+    if legacy is None:
+        return
+    if not RESET_TRANSFERS:
+        raise RuntimeError(
+            "migration 0002_transfer_natural_key deletes all transfers to collect"
+            " them again, set RESET_TRANSFERS=1 to apply it"
+        )
+
+    with engine.begin() as connection:
+        connection.execute(text("TRUNCATE transfers"))
+        connection.execute(text("DELETE FROM car_states"))
+        connection.execute(
+            text(
+                "ALTER TABLE transfers"
+                " DROP COLUMN id,"
+                " ADD COLUMN tx_hash BYTEA NOT NULL,"
+                " ADD COLUMN log_index INTEGER NOT NULL,"
+                " ADD PRIMARY KEY (tx_hash, log_index, token_id)"
+            )
+        )
+    logger.info("dropped the transfers, they are collected again")
+
+
+def _to_numeric(engine, table, key, columns):
+    """Online change of the VARCHAR `columns` of `table` to NUMERIC.
+
+    The values are copied into new columns in batches while a trigger keeps them
+    in sync with concurrent writes, and the columns are swapped in one short
+    transaction at the end. NOT NULL is restored through a check constraint that
+    is validated without blocking writes.
+    """
+    with engine.connect() as connection:
+        pending = connection.execute(
+            text(
+                "SELECT column_name FROM information_schema.columns"
+                " WHERE table_name = :table AND column_name = ANY(:columns)"
+                " AND data_type = 'character varying'"
+            ),
+            {"table": table, "columns": columns},
+        ).scalars()
+        pending = sorted(pending)
+    if len(pending) == 0:
+        return
+
+    logger.info(f"converting {', '.join(pending)} of {table} to NUMERIC")
+    function = f"{table}_to_numeric"
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"ALTER TABLE {table} "
+                + ", ".join(
+                    f"ADD COLUMN IF NOT EXISTS {column}_numeric NUMERIC"
+                    for column in pending
+                )
+            )
+        )
+        connection.execute(
+            text(
+                f"CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$"
+                " BEGIN "
+                + " ".join(
+                    f"NEW.{column}_numeric := NEW.{column}::numeric;"
+                    for column in pending
+                )
+                + " RETURN NEW; END $$ LANGUAGE plpgsql"
+            )
+        )
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {function} ON {table}"))
+        connection.execute(
+            text(
+                f"CREATE TRIGGER {function}"
+                f" BEFORE INSERT OR UPDATE ON {table}"
+                f" FOR EACH ROW EXECUTE FUNCTION {function}()"
+            )
+        )
+
+    assignments = ", ".join(
+        f"{column}_numeric = {table}.{column}::numeric" for column in pending
+    )
+    _backfill(engine, table, key, assignments)
+
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TRIGGER {function} ON {table}"))
+        connection.execute(text(f"DROP FUNCTION {function}"))
+        for column in pending:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} DROP COLUMN {column},"
+                    f" ADD CONSTRAINT {table}_{column}_not_null"
+                    f" CHECK ({column}_numeric IS NOT NULL) NOT VALID"
+                )
+            )
+            connection.execute(
+                text(f"ALTER TABLE {table} RENAME {column}_numeric TO {column}")
+            )
+
+    for column in pending:
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{column}_not_null"
+                )
+            )
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL,"
+                    f" DROP CONSTRAINT {table}_{column}_not_null"
+                )
+            )
+
+
+def _numeric_values(engine):
+    _to_numeric(engine, "transfers", ["tx_hash", "log_index", "token_id"], ["value"])
+    _to_numeric(engine, "prices", ["token_id", "timestamp"], ["value"])
+    _to_numeric(
+        engine,
+        "assets",
+        ["protocol_id", "timestamp"],
+        ["cet1", "credit_rwa", "market_rwa", "operational_rwa", "rwa"],
+    )
+
+    # token amounts scaled by their decimals, for analytics
+    with engine.begin() as connection:
+        connection.execute(
+            text("ALTER TABLE transfers ADD COLUMN IF NOT EXISTS amount FLOAT")
+        )
+    _backfill(
+        engine,
+        "transfers",
+        ["tx_hash", "log_index", "token_id"],
+        "amount = (transfers.value / 10 ^ tokens.decimals)::float8",
+        join="JOIN tokens ON tokens.id = batch.token_id",
+    )
+
+
+INDEXES = [
+    "ix_transfers_from_address ON transfers (from_address, token_id, timestamp)",
+    "ix_transfers_to_address ON transfers (to_address, token_id, timestamp)",
+    "ix_prices_timestamp ON prices (timestamp)",
+    "ix_assets_timestamp ON assets (timestamp)",
+    "ix_transfer_snapshots_queue ON transfer_snapshots"
+    " (priority DESC, treasury_id, from_timestamp, to_timestamp)",
+    "ix_price_snapshots_queue ON price_snapshots (priority DESC, token_id, timestamp)",
+]
+
+
+def _is_partitioned(connection, table):
+    return (
+        connection.execute(
+            text("SELECT relkind FROM pg_class WHERE relname = :table"),
+            {"table": table},
+        ).scalar()
+        == "p"
+    )
+
+
+def _indexes(engine):
+    """Build the secondary indexes of the models without blocking writes."""
+    with engine.connect() as connection:
+        # CONCURRENTLY cannot run inside a transaction
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        for index in INDEXES:
+            logger.info(f"creating index {index.split()[0]}")
+            # nor on partitioned tables, which `create_all` creates with their
+            # indexes
+            if _is_partitioned(connection, index.split()[2]):
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index}"))
+            else:
+                connection.execute(
+                    text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index}")
+                )
+
+
+def _partition(engine, model):
+    """Online conversion of the table of `model` to a partitioned table.
+
+    The existing table becomes the partition `<table>_history` of all rows up to
+    the end of next month, from where on monthly partitions are created on
+    insert. A validated check constraint of that range and indexes matching the
+    ones of the model let the partition be attached without scanning or
+    rebuilding anything, so writes are only blocked by one short transaction.
+    """
+    table = model.__tablename__
+    history = f"{table}_history"
+    with engine.connect() as connection:
+        if _is_partitioned(connection, table):
+            return
+        primary_key = connection.execute(
+            text(
+                "SELECT a.attname FROM pg_index i"
+                " JOIN pg_attribute a"
+                " ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)"
+                " WHERE i.indrelid = CAST(:table AS regclass) AND i.indisprimary"
+            ),
+            {"table": table},
+        ).scalars()
+        primary_key = set(primary_key)
+
+    logger.info(f"partitioning {table}")
+    # leaves a month for the migration before inserts fall outside of the bound
+    end = get_month(get_month(int(time.time()))[1])[1]
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {history}_bound,"
+                f" ADD CONSTRAINT {history}_bound CHECK (timestamp < {end}) NOT VALID"
+            )
+        )
+    with engine.begin() as connection:
+        connection.execute(
+            text(f"ALTER TABLE {table} VALIDATE CONSTRAINT {history}_bound")
+        )
+
+    # the primary key of a partition must contain the partition key
+    key = [column.name for column in model.__table__.primary_key]
+    if primary_key != set(key):
+        with engine.connect() as connection:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(
+                text(
+                    f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {history}_key"
+                    f" ON {table} ({', '.join(key)})"
+                )
+            )
+
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {table} RENAME TO {history}"))
+        if primary_key != set(key):
+            connection.execute(
+                text(
+                    f"ALTER TABLE {history} DROP CONSTRAINT {table}_pkey,"
+                    f" ADD CONSTRAINT {history}_pkey PRIMARY KEY USING INDEX"
+                    f" {history}_key"
+                )
+            )
+        else:
+            connection.execute(
+                text(f"ALTER INDEX {table}_pkey RENAME TO {history}_pkey")
+            )
+        for key in model.__table__.foreign_keys:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {history} RENAME CONSTRAINT"
+                    f" {table}_{key.parent.name}_fkey"
+                    f" TO {history}_{key.parent.name}_fkey"
+                )
+            )
+        for index in model.__table__.indexes:
+            connection.execute(
+                text(
+                    f"ALTER INDEX {index.name}"
+                    f" RENAME TO {index.name.replace(table, history)}"
+                )
+            )
+        model.__table__.create(connection)
+        connection.execute(
+            text(
+                f"ALTER TABLE {table} ATTACH PARTITION {history}"
+                f" FOR VALUES FROM (MINVALUE) TO ({end})"
+            )
+        )
+        connection.execute(
+            text(f"ALTER TABLE {history} DROP CONSTRAINT {history}_bound")
+        )
+
+
+def _partitions(engine):
+    _partition(engine, Transfer)
+    _partition(engine, Price)
+
+
+# Schema changes of existing tables, applied in order after `create_all`. New
+# tables are created by `create_all`, so every step must also be a no-op on a
+# freshly created schema. A migration is either a list of SQL statements applied
+# in one transaction, or a function of the engine for online migrations that
+# commit in batches.
+MIGRATIONS = [
+    (
+        "0001_snapshot_leases",
+        [
+            "ALTER TABLE transfer_snapshots"
+            " ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0,"
+            " ADD COLUMN IF NOT EXISTS retries INTEGER NOT NULL DEFAULT 0,"
+            " ADD COLUMN IF NOT EXISTS leased_until INTEGER",
+            "ALTER TABLE price_snapshots"
+            " ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0,"
+            " ADD COLUMN IF NOT EXISTS retries INTEGER NOT NULL DEFAULT 0,"
+            " ADD COLUMN IF NOT EXISTS leased_until INTEGER",
+        ],
+    ),
+    ("0002_transfer_natural_key", _transfer_natural_key),
+    (
+        "0003_transfer_checkpoints",
+        [
+            "ALTER TABLE transfer_snapshots"
+            " ADD COLUMN IF NOT EXISTS checkpoint INTEGER",
+        ],
+    ),
+    ("0004_numeric_values", _numeric_values),
+    ("0005_query_indexes", _indexes),
+    (
+        "0006_daily_flows",
+        [
+            # the next CAR run recomputes everything and fills daily_flows
+            "DELETE FROM car_states",
+        ],
+    ),
+    ("0007_partitions", _partitions),
+    (
+        "0008_car_invalidations",
+        [
+            # invalidations are appended to car_invalidations from now on
+            "ALTER TABLE car_states"
+            " ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0",
+        ],
+    ),
+]
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS migrations"
+                " (id VARCHAR PRIMARY KEY, applied_at TIMESTAMP DEFAULT now())"
+            )
+        )
+        applied = set(connection.execute(text("SELECT id FROM migrations")).scalars())
+
+    for migration_id, statements in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        logger.info(f"applying migration {migration_id}")
+        if callable(statements):
+            statements(engine)
+            statements = []
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO migrations (id) VALUES (:id)"), {"id": migration_id}
+            )
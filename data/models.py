@@ -1,6 +1,16 @@
+from decimal import Decimal
 from typing import Optional
 
-from sqlalchemy import ARRAY, ForeignKey, String
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    Numeric,
+    String,
+    text,
+)
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -41,6 +51,16 @@ class Token(Base):
 
 class TransferSnapshot(Base):
     __tablename__ = "transfer_snapshots"
+    __table_args__ = (
+        # claim order of the queue
+        Index(
+            "ix_transfer_snapshots_queue",
+            text("priority DESC"),
+            "treasury_id",
+            "from_timestamp",
+            "to_timestamp",
+        ),
+    )
 
     treasury_id: Mapped[str] = mapped_column(
         ForeignKey("treasuries.id"), primary_key=True
@@ -48,6 +68,11 @@ class TransferSnapshot(Base):
     treasury: Mapped["Treasury"] = relationship()
     from_timestamp: Mapped[int] = mapped_column(primary_key=True)
     to_timestamp: Mapped[int] = mapped_column(primary_key=True)
+    priority: Mapped[int] = mapped_column(default=0, server_default="0")
+    retries: Mapped[int] = mapped_column(default=0, server_default="0")
+    leased_until: Mapped[Optional[int]]
+    # last block whose transfers are stored, to resume a partly collected snapshot
+    checkpoint: Mapped[Optional[int]]
 
     def __str__(self):
         return f"{self.treasury_id}-{self.from_timestamp}-{self.to_timestamp}"
@@ -55,10 +80,19 @@ class TransferSnapshot(Base):
 
 class PriceSnapshot(Base):
     __tablename__ = "price_snapshots"
+    __table_args__ = (
+        # claim order of the queue
+        Index(
+            "ix_price_snapshots_queue", text("priority DESC"), "token_id", "timestamp"
+        ),
+    )
 
     token_id: Mapped[str] = mapped_column(ForeignKey("tokens.id"), primary_key=True)
     token: Mapped["Token"] = relationship()
     timestamp: Mapped[int] = mapped_column(primary_key=True)
+    priority: Mapped[int] = mapped_column(default=0, server_default="0")
+    retries: Mapped[int] = mapped_column(default=0, server_default="0")
+    leased_until: Mapped[Optional[int]]
 
     def __str__(self):
         return f"{self.token_id}-{self.timestamp}"
@@ -66,37 +100,104 @@ class PriceSnapshot(Base):
 
 class Transfer(Base):
     __tablename__ = "transfers"
+    __table_args__ = (
+        # flows of a treasury by token and time
+        Index("ix_transfers_from_address", "from_address", "token_id", "timestamp"),
+        Index("ix_transfers_to_address", "to_address", "token_id", "timestamp"),
+        # monthly partitions, see data.partitions
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
 
-    id: Mapped[str] = mapped_column(primary_key=True)
-    timestamp: Mapped[int]
-    block_number: Mapped[int]
-    token_id: Mapped[str] = mapped_column(ForeignKey("tokens.id"))
+    # a token transfer is the log `log_index` of transaction `tx_hash`
+    tx_hash: Mapped[bytes] = mapped_column(LargeBinary(32), primary_key=True)
+    log_index: Mapped[int] = mapped_column(primary_key=True)
+    token_id: Mapped[str] = mapped_column(ForeignKey("tokens.id"), primary_key=True)
     token: Mapped["Token"] = relationship()
+    # part of the key as the partition key
+    timestamp: Mapped[int] = mapped_column(primary_key=True)
+    block_number: Mapped[int]
     from_address: Mapped[str] = mapped_column(String(42))
     to_address: Mapped[str] = mapped_column(String(42))
-    value: Mapped[str]
+    value: Mapped[Decimal] = mapped_column(Numeric)
+    # value / 10**decimals of the token, for analytics
+    amount: Mapped[Optional[float]]
+
+
+# daily sums of the transfers of a treasury by token and flow category, without
+# transfers between treasuries of the same protocol
+class DailyFlow(Base):
+    __tablename__ = "daily_flows"
+
+    treasury_id: Mapped[str] = mapped_column(
+        ForeignKey("treasuries.id"), primary_key=True
+    )
+    token_id: Mapped[str] = mapped_column(ForeignKey("tokens.id"), primary_key=True)
+    # start of the day
+    timestamp: Mapped[int] = mapped_column(primary_key=True)
+    # fee_income, fee_expense, operating_income or operating_expense
+    category: Mapped[str] = mapped_column(String(17), primary_key=True)
+    value: Mapped[Decimal] = mapped_column(Numeric)
 
 
 class Price(Base):
     __tablename__ = "prices"
+    __table_args__ = (
+        Index("ix_prices_timestamp", "timestamp"),
+        # monthly partitions, see data.partitions
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
 
     token_id: Mapped[str] = mapped_column(ForeignKey("tokens.id"), primary_key=True)
     token: Mapped["Token"] = relationship()
     timestamp: Mapped[int] = mapped_column(primary_key=True)
-    value: Mapped[str]
+    value: Mapped[Decimal] = mapped_column(Numeric)
 
 
 class Assets(Base):
     __tablename__ = "assets"
+    __table_args__ = (Index("ix_assets_timestamp", "timestamp"),)
 
     protocol_id: Mapped[str] = mapped_column(
         ForeignKey("protocols.id"), primary_key=True
     )
     protocol: Mapped["Protocol"] = relationship()
     timestamp: Mapped[int] = mapped_column(primary_key=True)
-    cet1: Mapped[str]
-    credit_rwa: Mapped[str]
-    market_rwa: Mapped[str]
-    operational_rwa: Mapped[str]
-    rwa: Mapped[str]
+    cet1: Mapped[Decimal] = mapped_column(Numeric)
+    credit_rwa: Mapped[Decimal] = mapped_column(Numeric)
+    market_rwa: Mapped[Decimal] = mapped_column(Numeric)
+    operational_rwa: Mapped[Decimal] = mapped_column(Numeric)
+    rwa: Mapped[Decimal] = mapped_column(Numeric)
     car: Mapped[float]
+
+
+class CarState(Base):
+    __tablename__ = "car_states"
+
+    protocol_id: Mapped[str] = mapped_column(
+        ForeignKey("protocols.id"), primary_key=True
+    )
+    protocol: Mapped["Protocol"] = relationship()
+    timestamp: Mapped[int]
+    checkpoint: Mapped[int]
+    balances: Mapped[dict] = mapped_column(JSONB)
+    digest: Mapped[str]
+    # incremented by every run that saves the state, to detect concurrent runs
+    version: Mapped[int] = mapped_column(default=0, server_default="0")
+
+
+# days from which the CAR of a protocol is stale, appended by the ingestion and
+# consumed by the next CAR run of the protocol
+class CarInvalidation(Base):
+    __tablename__ = "car_invalidations"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    # None for all protocols, until `calculate_car` splits it per protocol
+    protocol_id: Mapped[Optional[str]] = mapped_column(ForeignKey("protocols.id"))
+    timestamp: Mapped[int]
+
+
+class Block(Base):
+    __tablename__ = "blocks"
+
+    timestamp: Mapped[int] = mapped_column(primary_key=True)
+    number: Mapped[int]
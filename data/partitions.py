@@ -0,0 +1,83 @@
+import datetime
+import re
+
+from sqlalchemy import text
+
+# bounds of the partitions of each table, as far as known to this process
+_partitions = {}
+
+
+def get_month(timestamp):
+    """Start and end timestamps of the month (UTC) of `timestamp`."""
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    start = date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def _to_bound(value):
+    value = value.strip("'")
+    if value == "MINVALUE":
+        return float("-inf")
+    if value == "MAXVALUE":
+        return float("inf")
+    return int(value)
+
+
+def get_partitions(connection, table):
+    """Bounds `(start, end)` of the range partitions of `table`."""
+    bounds = connection.execute(
+        text(
+            "SELECT pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits"
+            " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            " JOIN pg_class parent ON parent.oid = pg_inherits.inhparent"
+            " WHERE parent.relname = :table"
+        ),
+        {"table": table},
+    ).scalars()
+
+    partitions = []
+    for bound in bounds:
+        match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+        if match is not None:
+            partitions.append((_to_bound(match[1]), _to_bound(match[2])))
+    return partitions
+
+
+def _is_covered(partitions, timestamp):
+    return any(start <= timestamp < end for start, end in partitions)
+
+
+def create_partitions(engine, table, timestamps):
+    """Create the missing monthly partitions of `table` for rows at `timestamps`.
+
+    Runs in a transaction of its own, before the rows are inserted, since
+    creating a partition briefly locks the whole table.
+    """
+    months = set(get_month(timestamp) for timestamp in set(timestamps))
+    months = [
+        month
+        for month in months
+        if not _is_covered(_partitions.get(table, []), month[0])
+    ]
+    if len(months) == 0:
+        return
+
+    with engine.begin() as connection:
+        # serialize concurrent workers creating the same partition
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:table))"), {"table": table}
+        )
+        partitions = get_partitions(connection, table)
+        for start, end in sorted(months):
+            if _is_covered(partitions, start):
+                continue
+            month = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+            connection.execute(
+                text(
+                    f"CREATE TABLE {table}_{month:%Y_%m} PARTITION OF {table}"
+                    f" FOR VALUES FROM ({start}) TO ({end})"
+                )
+            )
+            partitions.append((start, end))
+    _partitions[table] = partitions
@@ -32,11 +32,11 @@ def get_all_assets(
             AssetModel(
                 protocol=asset.protocol_id,
                 timestamp=asset.timestamp,
-                cet1=asset.cet1,
-                credit_rwa=asset.credit_rwa,
-                market_rwa=asset.market_rwa,
-                operational_rwa=asset.operational_rwa,
-                rwa=asset.rwa,
+                cet1=format(asset.cet1, "f"),
+                credit_rwa=format(asset.credit_rwa, "f"),
+                market_rwa=format(asset.market_rwa, "f"),
+                operational_rwa=format(asset.operational_rwa, "f"),
+                rwa=format(asset.rwa, "f"),
             )
             for asset in assets
         ]
@@ -63,11 +63,11 @@ def get_single_assets(
             AssetModel(
                 protocol=asset.protocol_id,
                 timestamp=asset.timestamp,
-                cet1=asset.cet1,
-                credit_rwa=asset.credit_rwa,
-                market_rwa=asset.market_rwa,
-                operational_rwa=asset.operational_rwa,
-                rwa=asset.rwa,
+                cet1=format(asset.cet1, "f"),
+                credit_rwa=format(asset.credit_rwa, "f"),
+                market_rwa=format(asset.market_rwa, "f"),
+                operational_rwa=format(asset.operational_rwa, "f"),
+                rwa=format(asset.rwa, "f"),
             )
             for asset in assets
         ]
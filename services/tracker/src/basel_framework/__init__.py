@@ -1,16 +1,29 @@
+import hashlib
 import logging
-from decimal import Decimal
 
 import pandas as pd
 from basel_framework.cet1 import calculate_cet1
+from basel_framework.columnar import ColumnarSnapshot
 from basel_framework.credit import calculate_ccr_rwa
 from basel_framework.market import calculate_market_rwa
 from basel_framework.operational import calculate_operational_rwa
+from basel_framework.utils import (
+    INTERVAL,
+    NUMERIC,
+    CalculationContext,
+    PriceStore,
+    get_registry,
+    rebuild_daily_flows,
+    to_decimal_string,
+    to_number,
+)
 from joblib import Parallel, delayed
+from sqlalchemy import delete, literal, select, update
 from sqlalchemy.dialects.postgresql import insert
 
 from data.base import Session
-from data.models import Assets, Protocol
+from data.bulk import bulk_insert
+from data.models import Assets, CarInvalidation, CarState, Protocol, Treasury
 
 # logger
 logger = logging.getLogger(__file__)
@@ -22,19 +35,132 @@ sh = logging.StreamHandler()
 sh.setFormatter(formatter)
 logger.addHandler(sh)
 
+# config
+WINDOW = 365
+LOOKBACK = WINDOW + 7  # days of history needed to recompute a day
+CHECKPOINT = WINDOW + 30  # days between the stored balances and the last CAR
+
+
+def get_digest(protocol, registry):
+    """Fingerprint of everything besides transfers and prices that the CAR of a
+    protocol depends on. A stored `CarState` is only reused if it matches."""
+    state = (
+        NUMERIC,
+        registry.digest,
+        protocol.rating,
+        protocol.hacks,
+        sorted(protocol.addresses),
+        sorted(treasury.id for treasury in protocol.treasuries),
+    )
+    return hashlib.md5(repr(state).encode("utf-8")).hexdigest()
+
+
+def invalidate_car(session, timestamp, addresses=None):
+    """Mark the CAR from `timestamp` onwards as stale, either for the protocols
+    owning one of `addresses` or for all protocols.
 
-def _calculate_car(protocol):
+    Runs in the session of the caller so that it commits together with the
+    transfers or prices that caused it. The invalidation is appended to
+    `car_invalidations` rather than applied to the `CarState` rows, so that
+    concurrent ingestion never waits on their locks.
+    """
+    # the centered volatility window looks one day ahead
+    timestamp = timestamp // INTERVAL * INTERVAL - INTERVAL
+    if addresses is None:
+        stmt = insert(CarInvalidation).values(timestamp=timestamp)
+    else:
+        protocols = (
+            select(Treasury.protocol_id, literal(timestamp))
+            .where(Treasury.id.in_(addresses))
+            .distinct()
+        )
+        stmt = insert(CarInvalidation).from_select(
+            ["protocol_id", "timestamp"], protocols
+        )
+    session.execute(stmt)
+
+
+def split_invalidations(protocols):
+    """Replace the invalidations of all protocols by one invalidation of each of
+    `protocols`, so that every CAR run consumes its own."""
+    with Session() as session:
+        stmt = (
+            delete(CarInvalidation)
+            .where(CarInvalidation.protocol_id.is_(None))
+            .returning(CarInvalidation.timestamp)
+            .execution_options(synchronize_session=False)
+        )
+        timestamps = session.scalars(stmt).all()
+        if len(timestamps) > 0 and len(protocols) > 0:
+            session.execute(
+                insert(CarInvalidation).values(
+                    [
+                        dict(protocol_id=protocol.id, timestamp=min(timestamps))
+                        for protocol in protocols
+                    ]
+                )
+            )
+        session.commit()
+
+
+def _calculate_car(protocol, prices, registry, incremental=True):
     logger.info(f"calculating CAR for protocol {protocol.id}")
 
-    cet1 = calculate_cet1(protocol)
-    ccr_rwa = calculate_ccr_rwa(protocol)
-    mar_rwa = calculate_market_rwa(protocol).add(ccr_rwa, fill_value=Decimal(0.0))
-    ope_rwa = calculate_operational_rwa(protocol)
+    digest = get_digest(protocol, registry)
+    with Session() as session:
+        stored = session.get(CarState, protocol.id)
+        if stored is not None:
+            session.expunge(stored)
+        invalidations = session.execute(
+            select(CarInvalidation.id, CarInvalidation.timestamp).where(
+                CarInvalidation.protocol_id == protocol.id
+            )
+        ).all()
+
+    state = stored if incremental else None
+    if state is not None:
+        timestamp = min([state.timestamp, *(row.timestamp for row in invalidations)])
+    if state is not None and (
+        state.digest != digest or timestamp - state.checkpoint < LOOKBACK * INTERVAL
+    ):
+        logger.info(f"recomputing the full CAR history for protocol {protocol.id}")
+        state = None
+    if state is None:
+        # the daily flows depend on the addresses of the protocol
+        rebuild_daily_flows(protocol.id)
+
+    context = CalculationContext(protocol, prices, registry, state)
+    data = compute_car(context)
+    if state is not None:
+        data = data[data.index >= pd.to_datetime(timestamp, unit="s")]
+    rows = get_rows(protocol, data)
+    with Session() as session:
+        logger.debug(f"updating {len(data)} CAR values for protocol {protocol.id}")
+        bulk_insert(
+            session,
+            Assets,
+            rows,
+            index_elements=["protocol_id", "timestamp"],
+            update=list(data.columns),
+        )
+        session.commit()
+
+    save_state(
+        protocol, context.balance, digest, stored, [row.id for row in invalidations]
+    )
+
+
+def compute_car(context):
+    """Daily CET1, risk-weighted assets and CAR of the protocol of `context`."""
+    cet1 = calculate_cet1(context)
+    ccr_rwa = calculate_ccr_rwa(context)
+    mar_rwa = calculate_market_rwa(context).add(ccr_rwa, fill_value=to_number(0.0))
+    ope_rwa = calculate_operational_rwa(context)
 
     rwa = (
         pd.concat([ccr_rwa, mar_rwa, ope_rwa], axis=1)
         .dropna(how="all")
-        .fillna(Decimal(0.0))
+        .fillna(to_number(0.0))
     )
     data = pd.concat([cet1, rwa], axis=1).dropna(how="any")
 
@@ -42,26 +168,66 @@ def _calculate_car(protocol):
     data["rwa"] = data.credit_rwa + data.market_rwa + data.operational_rwa
     data["car"] = data.cet1.astype(float) / data.rwa.astype(float)
     data.dropna(inplace=True)
+    return data
+
+
+def get_rows(protocol, data):
+    """`Assets` rows of the CAR `data` of a protocol."""
+    data = data.copy()
+    for column in ["cet1", "credit_rwa", "market_rwa", "operational_rwa", "rwa"]:
+        data[column] = data[column].apply(to_decimal_string)
+    return [
+        dict(protocol_id=protocol.id, timestamp=dt.value // 10**9, **row)
+        for dt, row in zip(data.index, data.to_dict("records"))
+    ]
+
+
+def save_state(protocol, balance, digest, stored=None, invalidations=()):
+    """Store the state of a CAR run and consume the `invalidations` it covered.
 
+    The state is only replaced if no other run saved it in the meantime, and
+    invalidations committed during the run are left for the next one.
+    """
     with Session() as session:
-        logger.debug(f"updating {len(data)} CAR values for protocol {protocol.id}")
-        for dt, row in data.iterrows():
-            stmt = (
-                insert(Assets)
-                .values(
-                    protocol_id=protocol.id,
-                    timestamp=dt.value // 10**9,
-                    **dict(row),
+        saved = True
+        if len(balance) > 0:
+            timestamp = balance.index[-1].value // 10**9
+            checkpoint = timestamp - CHECKPOINT * INTERVAL
+            checkpoint_dt = pd.to_datetime(checkpoint, unit="s")
+            balances = {}
+            if checkpoint_dt in balance.index:
+                balances = balance.loc[checkpoint_dt].apply(to_decimal_string).to_dict()
+            values = dict(
+                timestamp=timestamp,
+                checkpoint=checkpoint,
+                balances=balances,
+                digest=digest,
+            )
+
+            if stored is None:
+                stmt = (
+                    insert(CarState)
+                    .values(protocol_id=protocol.id, **values)
+                    .on_conflict_do_nothing(index_elements=["protocol_id"])
                 )
-                .on_conflict_do_update(
-                    index_elements=["protocol_id", "timestamp"], set_=dict(row)
+            else:
+                stmt = (
+                    update(CarState)
+                    .where(
+                        CarState.protocol_id == protocol.id,
+                        CarState.version == stored.version,
+                    )
+                    .values(version=CarState.version + 1, **values)
                 )
-            )
+            saved = session.execute(stmt).rowcount == 1
+
+        if saved and len(invalidations) > 0:
+            stmt = delete(CarInvalidation).where(CarInvalidation.id.in_(invalidations))
             session.execute(stmt)
-            session.commit()
+        session.commit()
 
 
-def calculate_car():
+def calculate_car(incremental=True):
     with Session() as session:
         protocols = [
             protocol
@@ -69,6 +235,48 @@ def calculate_car():
             if len(protocol.treasuries) > 0
         ]
 
-    Parallel(backend="loky", n_jobs=8)(
-        [delayed(_calculate_car)(protocol) for protocol in protocols]
+    # before loading the prices, so that the prices of later invalidations of all
+    # protocols are left for the next run
+    split_invalidations(protocols)
+    # the price matrix is memory-mapped into the workers by joblib
+    prices = PriceStore.load()
+    registry = get_registry()
+    Parallel(backend="loky", n_jobs=8, max_nbytes="1M", mmap_mode="r")(
+        [
+            delayed(_calculate_car)(protocol, prices, registry, incremental)
+            for protocol in protocols
+        ]
+    )
+
+
+def _recompute_car(protocol, prices, registry, path):
+    logger.info(f"recomputing CAR for protocol {protocol.id} from {path}")
+
+    snapshot = ColumnarSnapshot(path)
+    context = CalculationContext(protocol, prices, registry, snapshot=snapshot)
+    return get_rows(protocol, compute_car(context))
+
+
+def recompute_car(path):
+    """Full CAR history of all protocols from the columnar snapshot in `path`, see
+    `export_snapshot`, without a database. Returns the rows as a DataFrame with
+    the columns of `Assets`."""
+    snapshot = ColumnarSnapshot(path)
+    protocols = [
+        protocol
+        for protocol in snapshot.get_protocols()
+        if len(protocol.treasuries) > 0
+    ]
+
+    prices = snapshot.get_prices()
+    registry = snapshot.get_registry()
+    rows = Parallel(backend="loky", n_jobs=8, max_nbytes="1M", mmap_mode="r")(
+        [
+            delayed(_recompute_car)(protocol, prices, registry, path)
+            for protocol in protocols
+        ]
+    )
+    return pd.DataFrame(
+        [row for protocol_rows in rows for row in protocol_rows],
+        columns=[column.name for column in Assets.__table__.columns],
     )
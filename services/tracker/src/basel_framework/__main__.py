@@ -0,0 +1,31 @@
+"""Export a columnar snapshot of the database, or recompute the CAR from one.
+
+`python -m basel_framework export snapshot/` writes the Parquet files and
+`python -m basel_framework recompute snapshot/ car.parquet` calculates the full
+CAR history of all protocols from them, without connecting to the database.
+"""
+
+import argparse
+
+from basel_framework import recompute_car
+from basel_framework.columnar import export_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write a snapshot")
+    export.add_argument("path", help="snapshot folder")
+    recompute = commands.add_parser("recompute", help="calculate the CAR offline")
+    recompute.add_argument("path", help="snapshot folder")
+    recompute.add_argument("output", help="Parquet file of the CAR")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_snapshot(args.path)
+    else:
+        recompute_car(args.path).to_parquet(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
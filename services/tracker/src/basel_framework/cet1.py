@@ -1,10 +1,6 @@
 import logging
-from decimal import Decimal
 
-from basel_framework.utils import get_daily_balance, get_tokens, get_usd_balance
-
-from data.base import Session
-from data.models import Token
+from basel_framework.utils import to_numeric
 
 # logger
 logger = logging.getLogger(__file__)
@@ -17,22 +13,21 @@ sh.setFormatter(formatter)
 logger.addHandler(sh)
 
 
-def calculate_cet1(protocol):
+def calculate_cet1(context):
+    protocol = context.protocol
     logger.debug(f"calculating CET1 for protocol {protocol.id}")
 
-    balance = get_daily_balance(protocol.id)
+    balance = context.balance
 
-    cash_tokens = balance.columns[balance.columns.isin(get_tokens("cash"))]
+    registry = context.registry
+    cash_tokens = balance.columns[balance.columns.isin(registry.get_tokens("cash"))]
     cash_balance = balance[cash_tokens].sum(axis=1)
 
-    share_tokens = balance.columns[balance.columns.isin(get_tokens("equity"))]
-    with Session() as session:
-        share_tokens = [
-            token
-            for token in share_tokens
-            if session.get(Token, token).protocol.id == protocol.id
-        ]
-    share_balance = get_usd_balance(balance[share_tokens]).sum(axis=1)
+    share_tokens = balance.columns[balance.columns.isin(registry.get_tokens("equity"))]
+    share_tokens = [
+        token for token in share_tokens if registry.get_protocol(token) == protocol.id
+    ]
+    share_balance = context.get_usd_balance(share_tokens).sum(axis=1)
 
-    cet1 = cash_balance.apply(Decimal) + share_balance.apply(Decimal)
+    cet1 = to_numeric(cash_balance) + to_numeric(share_balance)
     return cet1
@@ -0,0 +1,227 @@
+import collections
+import json
+import logging
+import os
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from basel_framework.utils import (
+    PriceStore,
+    TokenRegistry,
+    rebuild_daily_flows,
+    scale_flows,
+    select_daily_prices,
+)
+from sqlalchemy import select
+
+from data.base import Session
+from data.models import DailyFlow, Protocol
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - basel_framework/%(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+ROW_GROUP_SIZE = 100_000  # rows of the daily flows written and read at once
+
+SCHEMAS = {
+    "tokens": pa.schema(
+        [
+            ("id", pa.string()),
+            ("protocol_id", pa.string()),
+            ("itc_eep", pa.string()),
+            ("underlying", pa.string()),
+            ("decimals", pa.int64()),
+        ]
+    ),
+    "protocols": pa.schema(
+        [
+            ("id", pa.string()),
+            ("rating", pa.string()),
+            ("addresses", pa.list_(pa.string())),
+            ("treasuries", pa.list_(pa.string())),
+            # JSON list of the hacks
+            ("hacks", pa.string()),
+        ]
+    ),
+    "daily_flows": pa.schema(
+        [
+            ("treasury_id", pa.string()),
+            ("token_id", pa.string()),
+            ("timestamp", pa.int64()),
+            ("category", pa.string()),
+            # exact decimal strings of the sums of raw token amounts, which can
+            # exceed the 76 digits of the widest Arrow decimal
+            ("value", pa.string()),
+        ]
+    ),
+    "prices": pa.schema(
+        [
+            ("token_id", pa.string()),
+            ("day", pa.int64()),
+            # exact decimal strings of the NUMERIC prices, for the decimal backend
+            ("value", pa.string()),
+        ]
+    ),
+}
+
+
+def _write(path, name, rows, **kwargs):
+    table = pa.Table.from_pylist(rows, schema=SCHEMAS[name])
+    pq.write_table(table, os.path.join(path, f"{name}.parquet"), **kwargs)
+    logger.info(f"exported {len(table)} {name.replace('_', ' ')}")
+
+
+def _write_batches(path, name, batches):
+    """Write the row `batches` one row group at a time, so that the table is never
+    held in memory as a whole."""
+    count = 0
+    filename = os.path.join(path, f"{name}.parquet")
+    with pq.ParquetWriter(filename, SCHEMAS[name]) as writer:
+        for rows in batches:
+            writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMAS[name]))
+            count += len(rows)
+    logger.info(f"exported {count} {name.replace('_', ' ')}")
+
+
+def export_snapshot(path):
+    """Write the tokens, protocols, daily flows and daily prices the CAR is
+    calculated from as Parquet files into the folder `path`.
+
+    The daily flows of all protocols are rebuilt first, as they are only kept up
+    to date for protocols whose CAR was calculated since their addresses changed.
+    The files are then read from one snapshot of the database."""
+    os.makedirs(path, exist_ok=True)
+
+    with Session() as session:
+        protocol_ids = session.scalars(select(Protocol.id)).all()
+    for protocol_id in protocol_ids:
+        rebuild_daily_flows(protocol_id)
+    logger.info(f"rebuilt the daily flows of {len(protocol_ids)} protocols")
+
+    with Session() as session:
+        session.connection(
+            execution_options={
+                "isolation_level": "REPEATABLE READ",
+                "postgresql_readonly": True,
+            }
+        )
+        tokens, _ = TokenRegistry.query(session)
+        _write(path, "tokens", [token._asdict() for token in tokens])
+
+        protocols = session.query(Protocol).order_by(Protocol.id).all()
+        rows = [
+            dict(
+                id=protocol.id,
+                rating=protocol.rating,
+                addresses=protocol.addresses,
+                treasuries=[treasury.id for treasury in protocol.treasuries],
+                hacks=json.dumps(protocol.hacks),
+            )
+            for protocol in protocols
+        ]
+        _write(path, "protocols", rows)
+
+        # sorted by treasury so that reading one protocol skips most row groups
+        result = session.execute(
+            select(
+                DailyFlow.treasury_id,
+                DailyFlow.token_id,
+                DailyFlow.timestamp,
+                DailyFlow.category,
+                DailyFlow.value,
+            )
+            .order_by(DailyFlow.treasury_id, DailyFlow.timestamp)
+            .execution_options(yield_per=ROW_GROUP_SIZE)
+        )
+        batches = (
+            [{**flow._asdict(), "value": format(flow.value, "f")} for flow in batch]
+            for batch in result.partitions()
+        )
+        _write_batches(path, "daily_flows", batches)
+
+        prices = session.execute(select_daily_prices()).all()
+        rows = [
+            dict(token_id=token_id, day=day, value=format(value, "f"))
+            for token_id, day, value in prices
+        ]
+        _write(path, "prices", rows)
+
+
+class ColumnarSnapshot:
+    """Read-only view of a snapshot written by `export_snapshot`.
+
+    The Parquet files are read through memory maps, so the CAR can be recomputed
+    on any machine with a copy of the folder and without a database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._treasuries = None
+        self._decimals = None
+
+    def _read(self, name, **kwargs):
+        return pq.read_table(
+            os.path.join(self.path, f"{name}.parquet"), memory_map=True, **kwargs
+        )
+
+    def get_registry(self):
+        Token = collections.namedtuple("Token", SCHEMAS["tokens"].names)
+        tokens = [Token(**row) for row in self._read("tokens").to_pylist()]
+        Row = collections.namedtuple("Protocol", ["id", "rating"])
+        protocols = [
+            Row(**row)
+            for row in self._read("protocols", columns=["id", "rating"]).to_pylist()
+        ]
+        return TokenRegistry(tokens, protocols)
+
+    def get_prices(self):
+        return PriceStore.from_frame(self._read("prices").to_pandas())
+
+    def get_protocols(self):
+        return [
+            SimpleNamespace(
+                id=row["id"],
+                rating=row["rating"],
+                addresses=row["addresses"],
+                treasuries=[
+                    SimpleNamespace(id=treasury_id) for treasury_id in row["treasuries"]
+                ],
+                hacks=json.loads(row["hacks"]),
+            )
+            for row in self._read("protocols").to_pylist()
+        ]
+
+    def get_daily_flows(self, protocol_id, from_timestamp=None):
+        """Same as `get_daily_flows`, from the snapshot."""
+        logger.debug(f"reading daily flows for protocol {protocol_id}")
+
+        if self._treasuries is None:
+            protocols = self._read("protocols", columns=["id", "treasuries"])
+            self._treasuries = {
+                row["id"]: row["treasuries"] for row in protocols.to_pylist()
+            }
+            tokens = self._read("tokens", columns=["id", "decimals"]).to_pylist()
+            self._decimals = {row["id"]: row["decimals"] for row in tokens}
+
+        filters = [("treasury_id", "in", self._treasuries[protocol_id])]
+        if from_timestamp is not None:
+            filters.append(("timestamp", ">=", from_timestamp))
+        flows = self._read("daily_flows", filters=filters).to_pandas()
+        flows["value"] = flows["value"].map(Decimal)
+
+        flows = (
+            flows.groupby(["token_id", "timestamp", "category"])["value"]
+            .sum()
+            .reset_index()
+        )
+        flows["decimals"] = flows["token_id"].map(self._decimals)
+        return scale_flows(flows)
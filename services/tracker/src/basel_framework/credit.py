@@ -1,12 +1,8 @@
 import logging
-from decimal import Decimal
 
 import numpy as np
 import pandas as pd
-from basel_framework.utils import get_daily_balance, get_tokens, get_usd_balance
-
-from data.base import Session
-from data.models import Token
+from basel_framework.utils import sqrt, to_number, to_numeric
 
 # logger
 logger = logging.getLogger(__file__)
@@ -19,43 +15,41 @@ sh.setFormatter(formatter)
 logger.addHandler(sh)
 
 
-def get_relevant_protocols(balance):
+def get_relevant_protocols(balance, registry):
     protocols = {}
-    with Session() as session:
-        for token_id in balance.columns:
-            if token_id in get_tokens("cash"):
-                continue
-            protocol = session.get(Token, token_id).protocol
-            if protocol in protocols:
-                protocols[protocol].append(token_id)
-            else:
-                protocols[protocol] = [token_id]
+    for token_id in balance.columns:
+        if token_id in registry.get_tokens("cash"):
+            continue
+        protocol_id = registry.get_protocol(token_id)
+        if protocol_id in protocols:
+            protocols[protocol_id].append(token_id)
+        else:
+            protocols[protocol_id] = [token_id]
     return protocols
 
 
-def calculate_addons(usd_balance):
+def calculate_addons(usd_balance, registry):
     # separate entities
     entities = {}
-    with Session() as session:
-        for token in usd_balance.columns:
-            underlying = session.get(Token, token).underlying
-            if underlying in entities:
-                entities[underlying].append(token)
-            else:
-                entities[underlying] = [token]
+    for token in usd_balance.columns:
+        underlying = registry.get_underlying(token)
+        if underlying in entities:
+            entities[underlying].append(token)
+        else:
+            entities[underlying] = [token]
 
     # aggregate addons
-    addon_sum = pd.Series(Decimal(0.0), index=usd_balance.index)
-    addon_sq = pd.Series(Decimal(0.0), index=usd_balance.index)
+    addon_sum = pd.Series(to_number(0.0), index=usd_balance.index)
+    addon_sq = pd.Series(to_number(0.0), index=usd_balance.index)
     for entity, entity_tokens in entities.items():
         # index
-        if entity in get_tokens("index"):
-            sf = Decimal(0.2)
-            rho = Decimal(0.8)
+        if entity in registry.get_tokens("index"):
+            sf = to_number(0.2)
+            rho = to_number(0.8)
         # single entity
         else:
-            sf = Decimal(0.32)
-            rho = Decimal(0.5)
+            sf = to_number(0.32)
+            rho = to_number(0.5)
 
         if entity is None or len(entity_tokens) == 1:
             for entity_token in entity_tokens:
@@ -67,45 +61,49 @@ def calculate_addons(usd_balance):
             addon_sum += rho * addon_entity
             addon_sq += (1 - rho**2) * addon_entity**2
 
-    addon_agg = (addon_sum**2 + addon_sq).apply(lambda x: Decimal(x).sqrt())
+    addon_agg = sqrt(addon_sum**2 + addon_sq)
     return addon_agg
 
 
-def calculate_ccr_rwa(protocol):
-    logger.info(f"calculating counterparty credit risk for protocol {protocol.id}")
+def calculate_ccr_rwa(context):
+    logger.info(
+        f"calculating counterparty credit risk for protocol {context.protocol.id}"
+    )
 
-    balance = get_daily_balance(protocol.id)
-    protocols = get_relevant_protocols(balance)
+    balance = context.balance
+    registry = context.registry
+    protocols = get_relevant_protocols(balance, registry)
 
-    rwa = pd.Series(Decimal(0.0), index=balance.index)
+    rwa = pd.Series(to_number(0.0), index=balance.index)
 
-    for protocol, tokens in protocols.items():
+    for protocol_id, tokens in protocols.items():
         # exposure at default
-        usd_balance = get_usd_balance(balance[tokens])
-        addon = calculate_addons(usd_balance)
+        usd_balance = context.get_usd_balance(tokens)
+        addon = calculate_addons(usd_balance, registry)
 
         V = usd_balance.sum(axis=1)
-        C = V * Decimal(0.0)  # haircut value
+        C = V * to_number(0.0)  # haircut value
 
         multiplier = 0.05 + (1 - 0.05) * np.exp(
             (V - C).astype(float) / (2 * (1 - 0.05) * addon.astype(float))
         )
-        multiplier = multiplier.clip(upper=1.0).fillna(0.0).apply(Decimal)
+        multiplier = to_numeric(multiplier.clip(upper=1.0).fillna(0.0))
         pfe = multiplier * addon
 
-        ead = Decimal(1.4) * (V - C + pfe)
+        ead = to_number(1.4) * (V - C + pfe)
 
         # apply risk weight
-        if protocol.rating in ["AAA", "AA"]:
-            weight = Decimal(0.2)
-        elif protocol.rating in ["A"]:
-            weight = Decimal(0.5)
-        elif protocol.rating in ["BBB"]:
-            weight = Decimal(0.75)
-        elif protocol.rating in ["BB"]:
-            weight = Decimal(1.0)
+        rating = registry.get_rating(protocol_id)
+        if rating in ["AAA", "AA"]:
+            weight = to_number(0.2)
+        elif rating in ["A"]:
+            weight = to_number(0.5)
+        elif rating in ["BBB"]:
+            weight = to_number(0.75)
+        elif rating in ["BB"]:
+            weight = to_number(1.0)
         else:
-            weight = Decimal(1.5)
+            weight = to_number(1.5)
 
         rwa += weight * ead
 
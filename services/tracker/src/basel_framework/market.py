@@ -1,18 +1,8 @@
 import logging
-from decimal import Decimal
 
 import numpy as np
 import pandas as pd
-from basel_framework.utils import (
-    get_daily_balance,
-    get_token_category,
-    get_tokens,
-    get_usd_balance,
-    get_usd_prices,
-)
-
-from data.base import Session
-from data.models import Token
+from basel_framework.utils import to_number, to_numeric
 
 # logger
 logger = logging.getLogger(__file__)
@@ -28,9 +18,10 @@ logger.addHandler(sh)
 WINDOW = 365
 
 
-def calculate_sensitivities(token_id, underlying, token_balance):
-    V = get_usd_prices(token_id).astype(float)
-    S = get_usd_prices(underlying).astype(float)
+def calculate_sensitivities(context, token_id, underlying):
+    token_balance = context.balance[token_id]
+    V = context.get_usd_prices(token_id).astype(float)
+    S = context.get_usd_prices(underlying).astype(float)
     quantity = token_balance.astype(float) / V
 
     delta = (V.diff() / S.diff()).rolling(WINDOW, min_periods=1).median()
@@ -84,36 +75,35 @@ def aggregate_buckets(delta_buckets, vega_buckets, weight, rho, gamma):
     return np.sqrt(delta_net) + np.sqrt(vega_net)
 
 
-def calculate_market_rwa(protocol):
+def calculate_market_rwa(context):
+    protocol = context.protocol
     logger.info(f"calculating market risk for protocol {protocol.id}")
 
-    balance = get_daily_balance(protocol.id)
+    balance = context.balance
 
     # sensitivities
     logger.debug(f"calculating sensitivities for protocol {protocol.id}")
     delta_buckets = {}
     vega_buckets = {}
-    with Session() as session:
-        for token_id in balance.columns:
-            if token_id in get_tokens("cash"):
-                continue
-            underlying = session.get(Token, token_id).underlying
-            if underlying is None:
-                continue
-
-            delta, vega = calculate_sensitivities(
-                token_id, underlying, balance[token_id]
-            )
-            category = get_token_category(underlying)
-            if category in delta_buckets:
-                delta_buckets[category].append(delta)
-                vega_buckets[category].append(vega)
-            else:
-                delta_buckets[category] = [delta]
-                vega_buckets[category] = [vega]
+    registry = context.registry
+    for token_id in balance.columns:
+        if token_id in registry.get_tokens("cash"):
+            continue
+        underlying = registry.get_underlying(token_id)
+        if underlying is None:
+            continue
+
+        delta, vega = calculate_sensitivities(context, token_id, underlying)
+        category = registry.get_category(underlying)
+        if category in delta_buckets:
+            delta_buckets[category].append(delta)
+            vega_buckets[category].append(vega)
+        else:
+            delta_buckets[category] = [delta]
+            vega_buckets[category] = [vega]
 
     if len(delta_buckets) > 0:
-        sensitivities = (
+        sensitivities = to_numeric(
             pd.concat(
                 [
                     aggregate_buckets(delta_buckets, vega_buckets, 0.7, 0.075, 0.15),
@@ -125,41 +115,38 @@ def calculate_market_rwa(protocol):
                     ),
                 ],
                 axis=1,
-            )
-            .max(axis=1)
-            .apply(Decimal)
+            ).max(axis=1)
         )
     else:
-        sensitivities = Decimal(0.0)
+        sensitivities = to_number(0.0)
 
     # default risk capital requirements
     logger.debug(f"calculating default and residual risk for protocol {protocol.id}")
-    drc_rrao = get_usd_balance(balance)
-    with Session() as session:
-        for token_id in drc_rrao.columns:
-            if token_id in get_tokens("cash"):
-                drc_rrao[token_id] = Decimal(0.0)
-                continue
-
-            rating = session.get(Token, token_id).protocol.rating
-            if rating == "AAA":
-                weight = Decimal(0.005)
-            elif rating == "AA":
-                weight = Decimal(0.02)
-            elif rating == "A":
-                weight = Decimal(0.03)
-            elif rating == "BBB":
-                weight = Decimal(0.06)
-            elif rating == "BB":
-                weight = Decimal(0.15)
-            elif rating == "B":
-                weight = Decimal(0.30)
-            else:
-                weight = Decimal(0.50)
-            drc_rrao[token_id] *= weight + Decimal(0.001)  # RRAO
+    drc_rrao = context.get_usd_balance()
+    for token_id in drc_rrao.columns:
+        if token_id in registry.get_tokens("cash"):
+            drc_rrao[token_id] = to_number(0.0)
+            continue
+
+        rating = registry.get_rating(registry.get_protocol(token_id))
+        if rating == "AAA":
+            weight = to_number(0.005)
+        elif rating == "AA":
+            weight = to_number(0.02)
+        elif rating == "A":
+            weight = to_number(0.03)
+        elif rating == "BBB":
+            weight = to_number(0.06)
+        elif rating == "BB":
+            weight = to_number(0.15)
+        elif rating == "B":
+            weight = to_number(0.30)
+        else:
+            weight = to_number(0.50)
+        drc_rrao[token_id] *= weight + to_number(0.001)  # RRAO
 
     drc_rrao = drc_rrao.sum(axis=1)
 
-    rwa = Decimal(12.5) * (sensitivities + drc_rrao)
+    rwa = to_number(12.5) * (sensitivities + drc_rrao)
 
     return rwa
@@ -1,11 +1,17 @@
+import collections
+import hashlib
 import logging
+import os
 from datetime import datetime, timedelta
 from decimal import Decimal
 
+import numpy as np
 import pandas as pd
+from sqlalchemy import case, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
 
 from data.base import Session
-from data.models import Price, Protocol, Token, Transfer
+from data.models import DailyFlow, Price, Protocol, Token, Transfer, Treasury
 
 # logger
 logger = logging.getLogger(__file__)
@@ -17,6 +23,10 @@ sh = logging.StreamHandler()
 sh.setFormatter(formatter)
 logger.addHandler(sh)
 
+# config
+INTERVAL = 60 * 60 * 24  # daily
+NUMERIC = os.getenv("BASEL_NUMERIC", "float")  # "float" or "decimal"
+
 
 token_map = {
     "cash": [
@@ -50,85 +60,321 @@ token_map = {
 }
 
 
-def get_tokens(category):
-    assert (
-        category in token_map
-    ), f"token category should be one of the following: {list(token_map.keys())}"
+def to_number(value):
+    if NUMERIC == "decimal":
+        return Decimal(value)
+    return float(value)
+
+
+def to_numeric(data):
+    if NUMERIC == "decimal":
+        return data.apply(Decimal)
+    return data.astype(float)
+
+
+def sqrt(data):
+    if NUMERIC == "decimal":
+        return data.apply(lambda x: Decimal(x).sqrt())
+    return np.sqrt(data.astype(float))
+
+
+def to_decimal_string(value):
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(float(value)))
+    return format(value, "f")
+
+
+class TokenRegistry:
+    """Immutable in-memory view of the tokens and protocols tables.
+
+    Use `get_registry` to get the registry of the current process, which is loaded
+    once and reloaded after `invalidate_registry` is called.
+    """
+
+    def __init__(self, tokens, protocols):
+        state = (
+            sorted(tuple(token) for token in tokens),
+            sorted(tuple(protocol) for protocol in protocols),
+        )
+        self.digest = hashlib.md5(repr(state).encode("utf-8")).hexdigest()
+        self._protocol = {token.id: token.protocol_id for token in tokens}
+        self._itc_eep = {token.id: token.itc_eep for token in tokens}
+        self._underlying = {token.id: token.underlying for token in tokens}
+        self._decimals = {token.id: token.decimals for token in tokens}
+        self._rating = {protocol.id: protocol.rating for protocol in protocols}
+        self._categories = {
+            category: frozenset(
+                token_id
+                for token_id, itc_eep in self._itc_eep.items()
+                if itc_eep in itc_eeps
+            )
+            for category, itc_eeps in token_map.items()
+        }
+
+    @staticmethod
+    def query(session):
+        """Rows of the tokens and protocols the registry is built from."""
+        tokens = session.query(
+            Token.id,
+            Token.protocol_id,
+            Token.itc_eep,
+            Token.underlying,
+            Token.decimals,
+        ).all()
+        protocols = session.query(Protocol.id, Protocol.rating).all()
+        return tokens, protocols
+
+    @classmethod
+    def load(cls):
+        logger.debug("loading token registry")
+
+        with Session() as session:
+            tokens, protocols = cls.query(session)
+        return cls(tokens, protocols)
+
+    def get_tokens(self, category):
+        assert (
+            category in token_map
+        ), f"token category should be one of the following: {list(token_map.keys())}"
+        return self._categories[category]
+
+    def get_category(self, token_id):
+        itc_eep = self._itc_eep.get(token_id)
+        for key, values in token_map.items():
+            if itc_eep in values:
+                return key
+        raise KeyError(f"category unknown for {token_id}")
+
+    def get_protocol(self, token_id):
+        return self._protocol[token_id]
+
+    def get_underlying(self, token_id):
+        return self._underlying[token_id]
+
+    def get_decimals(self, token_id):
+        return self._decimals[token_id]
+
+    def get_rating(self, protocol_id):
+        return self._rating[protocol_id]
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = TokenRegistry.load()
+    return _registry
+
+
+def invalidate_registry():
+    global _registry
+    _registry = None
+
+
+def select_transfer_flows(treasuries, addresses):
+    """Query of the daily sums of the transfers of `treasuries` by treasury, token
+    and flow category, where transfers with `addresses` count as fees."""
+    outflow = Transfer.from_address.in_(treasuries)
+    inflow = Transfer.to_address.in_(treasuries)
+    treasury = case((outflow, Transfer.from_address), else_=Transfer.to_address)
+    category = case(
+        (outflow & Transfer.to_address.in_(addresses), "fee_expense"),
+        (outflow, "operating_expense"),
+        (Transfer.from_address.in_(addresses), "fee_income"),
+        else_="operating_income",
+    )
+    day = Transfer.timestamp - Transfer.timestamp % INTERVAL
+
+    return (
+        select(
+            treasury.label("treasury_id"),
+            Transfer.token_id,
+            day.label("timestamp"),
+            category.label("category"),
+            func.sum(Transfer.value).label("value"),
+        )
+        .where(outflow | inflow)
+        .where(~(outflow & inflow))
+        .group_by(treasury, Transfer.token_id, day, category)
+    )
+
+
+def lock_daily_flows(session, protocol_ids):
+    """Take the transaction level advisory locks of the daily flows of
+    `protocol_ids`, in a fixed order so that concurrent transactions cannot
+    deadlock."""
+    for protocol_id in sorted(protocol_ids):
+        session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            {"key": f"daily_flows/{protocol_id}"},
+        )
+
+
+def rebuild_daily_flows(protocol_id):
+    """Recompute the daily flows of the treasuries of a protocol from its
+    transfers, e.g. after its addresses changed."""
+    logger.debug(f"rebuilding daily flows for protocol {protocol_id}")
 
-    token_list = token_map[category]
     with Session() as session:
-        tokens = [
-            token.id
-            for token in session.query(Token.id).filter(Token.itc_eep.in_(token_list))
+        # wait for concurrent `add_daily_flows` of the protocol to commit, so that
+        # their transfers are counted exactly once
+        lock_daily_flows(session, [protocol_id])
+        protocol = session.get(Protocol, protocol_id)
+        assert protocol is not None, f"unknown protocol id {protocol_id}"
+        treasuries = [treasury.id for treasury in protocol.treasuries]
+
+        session.execute(delete(DailyFlow).where(DailyFlow.treasury_id.in_(treasuries)))
+        session.execute(
+            insert(DailyFlow).from_select(
+                ["treasury_id", "token_id", "timestamp", "category", "value"],
+                select_transfer_flows(treasuries, protocol.addresses),
+            )
+        )
+        session.commit()
+
+
+def add_daily_flows(session, transfers):
+    """Add newly stored `transfers` to the daily flows of their treasuries, within
+    the transaction of `session`.
+
+    Holds the locks of the affected protocols until the transaction ends, so that
+    `rebuild_daily_flows` either sees the transfers or runs before they are added.
+    """
+    treasuries = dict(session.query(Treasury.id, Treasury.protocol_id).all())
+    protocol_ids = set(treasuries.get(tx.from_address) for tx in transfers)
+    protocol_ids |= set(treasuries.get(tx.to_address) for tx in transfers)
+    protocol_ids.discard(None)
+    if len(protocol_ids) == 0:
+        return
+
+    lock_daily_flows(session, protocol_ids)
+    addresses = {
+        protocol.id: set(protocol.addresses)
+        for protocol in session.query(Protocol.id, Protocol.addresses).where(
+            Protocol.id.in_(protocol_ids)
+        )
+    }
+
+    flows = collections.defaultdict(int)
+    for tx in transfers:
+        day = tx.timestamp - tx.timestamp % INTERVAL
+        sender = treasuries.get(tx.from_address)
+        receiver = treasuries.get(tx.to_address)
+        if sender is not None and sender != receiver:
+            fee = tx.to_address in addresses[sender]
+            category = "fee_expense" if fee else "operating_expense"
+            flows[(tx.from_address, tx.token_id, day, category)] += tx.value
+        if receiver is not None and receiver != sender:
+            fee = tx.from_address in addresses[receiver]
+            category = "fee_income" if fee else "operating_income"
+            flows[(tx.to_address, tx.token_id, day, category)] += tx.value
+    if len(flows) == 0:
+        return
+
+    stmt = insert(DailyFlow).values(
+        [
+            dict(
+                treasury_id=treasury_id,
+                token_id=token_id,
+                timestamp=timestamp,
+                category=category,
+                value=value,
+            )
+            for (treasury_id, token_id, timestamp, category), value in flows.items()
         ]
-    return tokens
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["treasury_id", "token_id", "timestamp", "category"],
+        set_={"value": DailyFlow.value + stmt.excluded.value},
+    )
+    session.execute(stmt)
 
 
-def get_token_category(token_id):
-    with Session() as session:
-        itc_eep = session.get(Token, token_id).itc_eep
-    for key, values in token_map.items():
-        if itc_eep in values:
-            return key
-    raise KeyError(f"category unknown for {token_id}")
+def select_daily_flows(treasuries, from_timestamp=None):
+    """Query of the daily flows of `treasuries` by token and category."""
+    query = (
+        select(
+            DailyFlow.token_id,
+            DailyFlow.timestamp,
+            DailyFlow.category,
+            func.sum(DailyFlow.value).label("value"),
+            Token.decimals,
+        )
+        .join(Token, Token.id == DailyFlow.token_id)
+        .where(DailyFlow.treasury_id.in_(treasuries))
+    )
+    if from_timestamp is not None:
+        query = query.where(DailyFlow.timestamp >= from_timestamp)
+    return query.group_by(
+        DailyFlow.token_id, DailyFlow.timestamp, DailyFlow.category, Token.decimals
+    )
 
 
-def get_daily_balance(protocol_id):
-    logger.debug(f"fetching daily balance for protocol {protocol_id}")
+def get_daily_flows(protocol_id, from_timestamp=None):
+    logger.debug(f"fetching daily flows for protocol {protocol_id}")
 
     with Session() as session:
         protocol = session.get(Protocol, protocol_id)
         assert protocol is not None, f"unknown protocol id {protocol_id}"
         treasuries = [treasury.id for treasury in protocol.treasuries]
 
+        query = select_daily_flows(treasuries, from_timestamp)
+        flows = session.execute(query).all()
+
+    flows = pd.DataFrame(
+        flows, columns=["token_id", "timestamp", "category", "value", "decimals"]
+    )
+    return scale_flows(flows)
+
+
+def scale_flows(flows):
+    """Daily flows with timestamps as datetimes and values in whole tokens, from
+    the raw values and the decimals of their token."""
+    flows["timestamp"] = pd.to_datetime(flows["timestamp"], unit="s")
+    scale = flows["decimals"].map(lambda decimals: 10**decimals)
+    flows["value"] = to_numeric(flows["value"]) / to_numeric(scale)
+    return flows[["token_id", "timestamp", "category", "value"]]
+
+
+def get_daily_balance(protocol_id, flows=None, initial=None):
+    logger.debug(f"fetching daily balance for protocol {protocol_id}")
+
+    if flows is None:
+        flows = get_daily_flows(protocol_id)
+    outflows = flows["category"].isin(["fee_expense", "operating_expense"])
+    flows = flows.assign(value=flows["value"].where(~outflows, -flows["value"]))
+    # continue from the balances of a previous run
+    if initial is not None:
+        flows = pd.concat([initial, flows])
+
     balance = []
-    with Session() as session:
-        for token_id, decimals in session.query(Token.id, Token.decimals):
-            token_txs = []
-            for tx in (
-                session.query(Transfer)
-                .filter(Transfer.token_id == token_id)
-                .filter(
-                    Transfer.from_address.in_(treasuries)
-                    | Transfer.to_address.in_(treasuries)
-                )
-            ):
-                if tx.from_address in treasuries:
-                    if tx.to_address in treasuries:
-                        continue
-                    else:
-                        value = -Decimal(tx.value)
-                else:
-                    value = Decimal(tx.value)
-                value /= Decimal(10**decimals)
-
-                token_txs.append({"timestamp": tx.timestamp, "value": value})
-
-            if len(token_txs) == 0:
-                continue
-
-            token_df = pd.DataFrame(token_txs)
-            token_dt = pd.to_datetime(token_df["timestamp"], unit="s")
-            token_df = token_df.set_index(token_dt).drop(columns=["timestamp"]).value
-            token_df = token_df.groupby(pd.Grouper(freq="D")).sum()
-
-            token_balance = token_df.cumsum()
-            token_balance.name = token_id
-
-            while (token_balance < 0).any():
-                logger.warning(
-                    f"negative daily balance of token {token_id} for protocol {protocol_id}"
-                )
-                idx = token_balance[token_balance < 0].index[0]
-                diff = -token_balance[idx]
-                token_balance[idx:] += diff
-
-            balance.append(token_balance)
+    for token_id, token_df in flows.groupby("token_id"):
+        token_df = token_df.set_index("timestamp").value
+        token_df = token_df.groupby(pd.Grouper(freq="D")).sum()
+
+        token_balance = token_df.cumsum()
+        token_balance.name = token_id
+
+        # lift the balance by the lowest negative balance seen so far
+        zero = to_number(0.0)
+        floor = token_balance.cummin()
+        floor = floor.where(floor < zero, zero)
+        if floor.iloc[-1] < zero:
+            corrections = (floor != floor.shift(fill_value=zero)).sum()
+            logger.warning(
+                f"corrected {corrections} negative daily balances of token {token_id} "
+                f"for protocol {protocol_id} by {-floor.iloc[-1]} in total"
+            )
+            token_balance = token_balance - floor
+
+        balance.append(token_balance)
 
     if len(balance) == 0:
         return pd.DataFrame(None)
 
-    balance = pd.concat(balance, axis=1).fillna(method="ffill").fillna(Decimal(0.0))
+    balance = pd.concat(balance, axis=1).fillna(method="ffill").fillna(to_number(0.0))
     index = pd.date_range(
         start=balance.index[0], end=datetime.now() - timedelta(days=1), freq="D"
     )
@@ -136,39 +382,124 @@ def get_daily_balance(protocol_id):
     return balance
 
 
-def get_usd_prices(token_id):
-    with Session() as session:
-        prices = (
-            session.query(Price.timestamp, Price.value)
-            .filter(Price.token_id == token_id)
-            .all()
+def select_daily_prices():
+    """Query of the last price of each token and day."""
+    day = (Price.timestamp // INTERVAL).label("day")
+    return (
+        select(Price.token_id, day, Price.value)
+        .distinct(Price.token_id, day)
+        .order_by(Price.token_id, day, Price.timestamp.desc())
+    )
+
+
+class PriceStore:
+    """Daily USD prices of all tokens as a dense (day x token) matrix, of floats or
+    of the exact `Decimal` prices with the decimal backend.
+
+    Prices are forward-filled between the first and the last price of each token.
+    The store is built once per CAR run and handed to the loky workers, which
+    receive a float matrix as a memory-mapped file instead of a copy.
+    """
+
+    def __init__(self, values, days, tokens):
+        self.values = values
+        self.index = pd.to_datetime(days * INTERVAL, unit="s")
+        self.columns = {token_id: idx for idx, token_id in enumerate(tokens)}
+
+    @classmethod
+    def load(cls):
+        logger.debug("loading daily USD prices")
+
+        with Session() as session:
+            prices = session.execute(select_daily_prices()).all()
+        return cls.from_frame(
+            pd.DataFrame(prices, columns=["token_id", "day", "value"])
         )
-        prices_df = pd.DataFrame(prices)
-        if len(prices_df) == 0:
+
+    @classmethod
+    def from_frame(cls, prices):
+        """Store of the `token_id`, `day` and `value` columns of `prices`."""
+        if len(prices) == 0:
+            return cls(np.empty((0, 0)), np.empty(0, dtype=int), [])
+
+        if NUMERIC == "decimal":
+            values = prices["value"].map(Decimal)
+        else:
+            values = prices["value"].astype(float)
+        prices = prices.assign(value=values)
+        prices = prices.pivot(index="day", columns="token_id", values="value")
+        prices = prices.reindex(np.arange(prices.index.min(), prices.index.max() + 1))
+        prices = prices.ffill().where(prices.bfill().notna())
+        return cls(prices.to_numpy(), prices.index.to_numpy(), prices.columns)
+
+    def get(self, token_id):
+        if token_id not in self.columns:
             logger.warning(f"could not find price data for token {token_id}")
-            return prices_df
+            return pd.Series(index=pd.DatetimeIndex([]), dtype=float)
 
-        prices_dt = pd.to_datetime(prices_df["timestamp"], unit="s")
-        prices_df = prices_df.set_index(prices_dt).drop(columns=["timestamp"]).value
-        prices_df = (
-            prices_df.groupby(pd.Grouper(freq="D")).last().fillna(method="ffill")
-        )
-    return prices_df.apply(Decimal)
+        prices = pd.Series(self.values[:, self.columns[token_id]], index=self.index)
+        return prices.dropna()
 
 
-def get_usd_balance(balance):
+def get_usd_balance(balance, usd_prices, registry):
     balance = balance.copy()
     for token_id in balance.columns:
-        if token_id in get_tokens("cash"):
+        if token_id in registry.get_tokens("cash"):
             continue
-        prices_df = get_usd_prices(token_id)
+        prices_df = usd_prices(token_id)
         token_index = balance[token_id].dropna().index
         prices_df = prices_df.reindex(token_index).fillna(method="ffill")
         if prices_df.isna().any():
             idx = prices_df.index[prices_df.isna()][-1]
             logger.warning(f"missing prices of token {token_id} before {idx}")
-            prices_df.fillna(Decimal(0.0), inplace=True)
+            prices_df.fillna(to_number(0.0), inplace=True)
 
         balance.loc[:, token_id] *= prices_df
 
     return balance
+
+
+class CalculationContext:
+    """Daily flows, balances and USD prices of a protocol, loaded once per CAR run
+    and shared by the CET1, credit, market and operational calculators together
+    with the token registry of the run.
+
+    Given the `CarState` of a previous run, only the flows after its checkpoint are
+    loaded and the balances continue from the checkpoint balances. Given a
+    `ColumnarSnapshot`, the flows are read from it instead of the database.
+    """
+
+    def __init__(self, protocol, prices, registry, state=None, snapshot=None):
+        self.protocol = protocol
+        self.prices = prices
+        self.registry = registry
+        get_flows = get_daily_flows if snapshot is None else snapshot.get_daily_flows
+        if state is None:
+            self.flows = get_flows(protocol.id)
+            self.balance = get_daily_balance(protocol.id, self.flows)
+        else:
+            self.flows = get_flows(protocol.id, state.checkpoint + INTERVAL)
+            initial = pd.DataFrame(
+                {
+                    "token_id": list(state.balances.keys()),
+                    "timestamp": pd.to_datetime(state.checkpoint, unit="s"),
+                    "value": [to_number(value) for value in state.balances.values()],
+                }
+            )
+            self.balance = get_daily_balance(protocol.id, self.flows, initial)
+        self._usd_prices = {}
+        self._usd_balance = None
+
+    def get_usd_prices(self, token_id):
+        if token_id not in self._usd_prices:
+            self._usd_prices[token_id] = self.prices.get(token_id)
+        return self._usd_prices[token_id]
+
+    def get_usd_balance(self, tokens=None):
+        if self._usd_balance is None:
+            self._usd_balance = get_usd_balance(
+                self.balance, self.get_usd_prices, self.registry
+            )
+        if tokens is None:
+            return self._usd_balance.copy()
+        return self._usd_balance[tokens]
@@ -0,0 +1,155 @@
+"""Ingestion benchmark of collect_transfers and collect_prices against the local
+Etherscan and DefiLlama stub.
+
+The benchmark writes snapshots, transfers and prices to the configured
+database, so point POSTGRES_DB at a scratch database. Run it from the repository
+root, e.g. `python -m benchmark --days 30 --latency 0.05 --rate-limit 20`.
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+import requests
+from benchmark.stub import add_arguments, from_arguments, start_stub
+
+from data.base import Base, Session, engine
+from data.migrations import migrate
+from data.models import (
+    DailyFlow,
+    Price,
+    PriceSnapshot,
+    Token,
+    Transfer,
+    TransferSnapshot,
+    Treasury,
+)
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - benchmark/%(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+INTERVAL = 60 * 60 * 24  # daily
+END_TIMESTAMP = 1690848000  # 2023-Aug-01
+
+
+def queue_snapshots(treasuries, tokens, days):
+    """Queue `days` daily snapshots for the first `treasuries` treasuries and the
+    first `tokens` tokens, after removing what earlier runs collected for them."""
+    timestamps = [END_TIMESTAMP - (days - idx) * INTERVAL for idx in range(days + 1)]
+    with Session() as session:
+        treasury_ids = [
+            treasury.id
+            for treasury in session.query(Treasury)
+            .order_by(Treasury.id)
+            .limit(treasuries)
+        ]
+        token_ids = [
+            token.id for token in session.query(Token).order_by(Token.id).limit(tokens)
+        ]
+
+        session.query(TransferSnapshot).delete()
+        session.query(PriceSnapshot).delete()
+        session.query(Transfer).filter(
+            Transfer.timestamp >= timestamps[0],
+            Transfer.from_address.in_(treasury_ids)
+            | Transfer.to_address.in_(treasury_ids),
+        ).delete(synchronize_session=False)
+        session.query(DailyFlow).filter(
+            DailyFlow.timestamp >= timestamps[0],
+            DailyFlow.treasury_id.in_(treasury_ids),
+        ).delete(synchronize_session=False)
+        session.query(Price).filter(
+            Price.timestamp >= timestamps[0], Price.token_id.in_(token_ids)
+        ).delete(synchronize_session=False)
+
+        session.add_all(
+            TransferSnapshot(
+                treasury_id=treasury_id, from_timestamp=start, to_timestamp=end
+            )
+            for treasury_id in treasury_ids
+            for start, end in zip(timestamps[:-1], timestamps[1:])
+        )
+        session.add_all(
+            PriceSnapshot(token_id=token_id, timestamp=timestamp)
+            for token_id in token_ids
+            for timestamp in timestamps[1:]
+        )
+        session.commit()
+
+
+def count(model):
+    with Session() as session:
+        return session.query(model).count()
+
+
+def measure(name, snapshot_model, row_model, drain):
+    snapshots = count(snapshot_model)
+    rows = count(row_model)
+    start = time.perf_counter()
+    drain()
+    elapsed = time.perf_counter() - start
+    left = count(snapshot_model)
+    collected = snapshots - left
+    rows = count(row_model) - rows
+    logger.info(
+        f"{name}: {collected} snapshots and {rows} rows in {elapsed:.1f}s, "
+        f"{collected / elapsed:.1f} snapshots/sec, {rows / elapsed:.1f} rows/sec, "
+        f"{left} snapshots left for retries"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--treasuries", type=int, default=20)
+    parser.add_argument("--token-count", type=int, default=50)
+    parser.add_argument("--price-workers", type=int, default=8)
+    args = parser.parse_args()
+
+    url = start_stub(from_arguments(args), args.host, args.port)
+    os.environ["ETHERSCAN_URL"] = f"{url}/api"
+    os.environ["DEFILLAMA_URL"] = url
+    # the collectors read their base URL on import
+    from prices import collect_prices
+    from snapshots import update_protocols, update_tokens
+    from transfers import collect_transfers
+
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    update_protocols()
+    update_tokens()
+    queue_snapshots(args.treasuries, args.token_count, args.days)
+
+    def drain_transfers():
+        while collect_transfers():
+            pass
+
+    def drain_prices():
+        def work():
+            with requests.Session() as http:
+                while collect_prices(http):
+                    pass
+
+        threads = [threading.Thread(target=work) for _ in range(args.price_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    measure("collect_transfers", TransferSnapshot, Transfer, drain_transfers)
+    measure("collect_prices", PriceSnapshot, Price, drain_prices)
+
+
+if __name__ == "__main__":
+    main()
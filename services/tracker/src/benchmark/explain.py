@@ -0,0 +1,194 @@
+"""Check that the hot queries of the tracker and the server use their indexes.
+
+Every query is planned with sequential scans disabled, so a plan that still scans
+one of the large tables, or that does not use the indexes expected for the query,
+has lost an index it relies on. Exits with status 1 if any does.
+
+The schema is created and migrated and the protocols are loaded if missing, so
+the check also runs against an empty database, e.g. in Docker Compose with
+`docker compose run --rm explain`, or from the repository root with
+`python -m benchmark.explain`.
+"""
+
+import json
+import logging
+import sys
+
+from basel_framework.utils import select_daily_flows, select_transfer_flows
+from snapshots import (
+    create_timestamps,
+    select_claimable,
+    select_missing_prices,
+    select_missing_transfers,
+    update_protocols,
+)
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+
+from data.base import Base, Session, engine
+from data.migrations import migrate
+from data.models import (
+    Assets,
+    Price,
+    PriceSnapshot,
+    Protocol,
+    Transfer,
+    TransferSnapshot,
+)
+from data.partitions import create_partitions
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - benchmark/%(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+TABLES = [
+    "transfers",
+    "daily_flows",
+    "prices",
+    "assets",
+    "transfer_snapshots",
+    "price_snapshots",
+]
+DAYS = 30  # range of the daily checks
+
+
+def get_queries():
+    with Session() as session:
+        protocol = max(session.query(Protocol).all(), key=lambda p: len(p.treasuries))
+        treasuries = [treasury.id for treasury in protocol.treasuries]
+        addresses = protocol.addresses
+    timestamps = create_timestamps()[-DAYS:]
+
+    return {
+        "daily flows": (select_daily_flows(treasuries), ["daily_flows_pkey"]),
+        "daily flows since": (
+            select_daily_flows(treasuries, timestamps[0]),
+            ["daily_flows_pkey"],
+        ),
+        "transfer flows": (
+            select_transfer_flows(treasuries, addresses),
+            ["ix_transfers_from_address", "ix_transfers_to_address"],
+        ),
+        "missing transfers": (
+            select_missing_transfers(timestamps),
+            ["ix_transfers_from_address", "ix_transfers_to_address"],
+        ),
+        "missing prices": (
+            select_missing_prices(timestamps),
+            [("prices_pkey", "ix_prices_timestamp")],
+        ),
+        "claimable transfers": (
+            select_claimable(TransferSnapshot, 64),
+            ["ix_transfer_snapshots_queue"],
+        ),
+        "claimable prices": (
+            select_claimable(PriceSnapshot, 64),
+            ["ix_price_snapshots_queue"],
+        ),
+        "prices by timestamp": (
+            select(Price).where(
+                Price.timestamp >= timestamps[0], Price.timestamp < timestamps[-1]
+            ),
+            ["ix_prices_timestamp"],
+        ),
+        "assets by timestamp": (
+            select(Assets).where(
+                Assets.timestamp >= timestamps[0], Assets.timestamp < timestamps[-1]
+            ),
+            ["ix_assets_timestamp"],
+        ),
+    }
+
+
+def get_parents(session):
+    """Partitioned table or index of each partition and partition index."""
+    rows = session.execute(
+        text(
+            "SELECT child.relname, parent.relname FROM pg_inherits"
+            " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            " JOIN pg_class parent ON parent.oid = pg_inherits.inhparent"
+        )
+    ).all()
+    return dict(rows)
+
+
+def get_scans(plan, parents):
+    """Indexes used in `plan`, and tables of TABLES read by a sequential scan,
+    by the names of their partitioned index or table if any."""
+    indexes = set()
+    tables = set()
+    if "Index Name" in plan:
+        indexes.add(parents.get(plan["Index Name"], plan["Index Name"]))
+    if plan["Node Type"] == "Seq Scan":
+        table = parents.get(plan["Relation Name"], plan["Relation Name"])
+        if table in TABLES:
+            tables.add(table)
+    for child in plan.get("Plans", []):
+        child_indexes, child_tables = get_scans(child, parents)
+        indexes |= child_indexes
+        tables |= child_tables
+    return indexes, tables
+
+
+def explain(session, query):
+    sql = query.compile(
+        dialect=postgresql.dialect(paramstyle="named"),
+        compile_kwargs={"literal_binds": True},
+    )
+    result = session.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]["Plan"]
+
+
+def prepare():
+    """Create and migrate the schema, and load the protocols and create the
+    partitions the queries are planned for if there are none."""
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    with Session() as session:
+        if session.query(Protocol).count() == 0:
+            update_protocols()
+    timestamps = create_timestamps()[-DAYS:]
+    for model in [Transfer, Price]:
+        create_partitions(engine, model.__tablename__, timestamps)
+
+
+def main():
+    prepare()
+    failed = []
+    with Session() as session:
+        session.execute(text("SET LOCAL enable_seqscan = off"))
+        parents = get_parents(session)
+        for name, (query, expected) in get_queries().items():
+            indexes, tables = get_scans(explain(session, query), parents)
+            # an entry of `expected` is an index name or a tuple of alternatives
+            expected = [
+                (index,) if isinstance(index, str) else index for index in expected
+            ]
+            missing = [
+                " or ".join(index) for index in expected if indexes.isdisjoint(index)
+            ]
+            if len(tables) > 0:
+                logger.error(f"{name}: sequential scan on {', '.join(sorted(tables))}")
+                failed.append(name)
+            elif len(missing) > 0:
+                logger.error(f"{name}: not using {', '.join(missing)}")
+                failed.append(name)
+            else:
+                logger.info(f"{name}: ok")
+        session.rollback()
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+
+from aiohttp import web
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - benchmark/%(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+BLOCK_TIME = 12  # seconds
+BLOCKS_PER_DAY = 60 * 60 * 24 // BLOCK_TIME
+
+
+class Stub:
+    """Stand-in for the Etherscan and DefiLlama endpoints used by the tracker.
+
+    Answers `getblocknobytime`, `tokentx` and `batchHistorical` from recorded
+    fixtures, or with deterministic synthetic data for the given tokens. Every
+    request waits `latency` seconds, fails with probability `error_rate` and is
+    rejected once more than `rate_limit` requests arrive within a second, in the
+    same way as the real APIs.
+
+    Fixtures are a JSON file of the form
+    `{"tokentx": {address: [tx, ...]}, "prices": {coin: [[timestamp, price], ...]}}`
+    with the transactions as returned by Etherscan.
+    """
+
+    def __init__(
+        self,
+        tokens,
+        txs_per_day=10,
+        latency=0.0,
+        rate_limit=None,
+        error_rate=0.0,
+        fixtures=None,
+        seed=0,
+    ):
+        self.tokens = sorted(tokens)
+        self.txs_per_day = txs_per_day
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self._requests = collections.deque()
+
+        self.tokentx = None
+        self.prices = None
+        if fixtures is not None:
+            with open(fixtures) as f:
+                data = json.load(f)
+            self.tokentx = {
+                address.lower(): sorted(txs, key=lambda tx: int(tx["blockNumber"]))
+                for address, txs in data.get("tokentx", {}).items()
+            }
+            self.prices = {
+                coin: sorted(prices) for coin, prices in data.get("prices", {}).items()
+            }
+
+    def _digest(self, *parts):
+        return int(hashlib.md5(repr((self.seed, *parts)).encode()).hexdigest(), 16)
+
+    async def _throttle(self):
+        """Returns the reason to reject the request, if any."""
+        await asyncio.sleep(self.latency)
+        if self.rate_limit is not None:
+            now = asyncio.get_running_loop().time()
+            while len(self._requests) > 0 and self._requests[0] < now - 1:
+                self._requests.popleft()
+            if len(self._requests) >= self.rate_limit:
+                return "Max rate limit reached"
+            self._requests.append(now)
+        if self.random.random() < self.error_rate:
+            return "Internal error"
+        return None
+
+    def get_block_number(self, timestamp):
+        return timestamp // BLOCK_TIME
+
+    def get_transactions(self, address, from_block, to_block, limit):
+        if self.tokentx is not None:
+            txs = self.tokentx.get(address, [])
+            blocks = [int(tx["blockNumber"]) for tx in txs]
+            start = bisect.bisect_left(blocks, from_block)
+            end = bisect.bisect_right(blocks, to_block)
+            return txs[start : min(end, start + limit)]
+
+        txs = []
+        step = max(BLOCKS_PER_DAY // self.txs_per_day, 1)
+        block = from_block + (self._digest(address) - from_block) % step
+        while block <= to_block and len(txs) < limit:
+            digest = self._digest(address, block)
+            counterparty = f"0x{digest % 16**40:040x}"
+            inflow = digest % 2 == 0
+            txs.append(
+                {
+                    "blockNumber": str(block),
+                    "timeStamp": str(block * BLOCK_TIME),
+                    "hash": "0x" + f"{self._digest('tx', address, block):032x}" * 2,
+                    "blockHash": "0x" + f"{self._digest('block', block):032x}" * 2,
+                    "from": counterparty if inflow else address,
+                    "to": address if inflow else counterparty,
+                    "contractAddress": self.tokens[digest % len(self.tokens)],
+                    "value": str(digest % 10**24),
+                    "transactionIndex": str(digest % 200),
+                    "logIndex": str(digest % 500),
+                }
+            )
+            block += step
+        return txs
+
+    def get_price(self, coin, timestamp):
+        if self.prices is not None:
+            prices = self.prices.get(coin, [])
+            idx = bisect.bisect_right(prices, [timestamp, float("inf")])
+            if idx == 0:
+                return None
+            return {"timestamp": prices[idx - 1][0], "price": prices[idx - 1][1]}
+
+        price = 1 + self._digest(coin, timestamp // 3600) % 10**6 / 10**4
+        return {"timestamp": timestamp, "price": price, "confidence": 0.99}
+
+    async def etherscan(self, request):
+        error = await self._throttle()
+        if error is not None:
+            return web.json_response(
+                {"status": "0", "message": "NOTOK", "result": error}
+            )
+
+        query = request.query
+        if query.get("action") == "getblocknobytime":
+            number = self.get_block_number(int(query["timestamp"]))
+            return web.json_response(
+                {"status": "1", "message": "OK", "result": str(number)}
+            )
+
+        txs = self.get_transactions(
+            query["address"].lower(),
+            int(query["startblock"]),
+            int(query["endblock"]),
+            int(query.get("offset", 10000)),
+        )
+        if len(txs) == 0:
+            return web.json_response(
+                {"status": "0", "message": "No transactions found", "result": []}
+            )
+        return web.json_response({"status": "1", "message": "OK", "result": txs})
+
+    async def batch_historical(self, request):
+        error = await self._throttle()
+        if error is not None:
+            status = 429 if error == "Max rate limit reached" else 500
+            return web.json_response({"message": error}, status=status)
+
+        coins = {}
+        for coin, timestamps in json.loads(request.query["coins"]).items():
+            prices = [self.get_price(coin, timestamp) for timestamp in timestamps]
+            prices = [price for price in prices if price is not None]
+            coins[coin] = {"symbol": coin[-4:], "prices": prices}
+        return web.json_response({"coins": coins})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api", self.etherscan)
+        app.router.add_get("/batchHistorical", self.batch_historical)
+        return app
+
+
+def load_tokens(path="data/tokens"):
+    return [filename.split(".")[0].lower() for filename in os.listdir(path)]
+
+
+def start_stub(stub, host="127.0.0.1", port=8999):
+    """Serve `stub` from a background thread, returns its base URL."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(stub.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    logger.info(f"serving stub on http://{host}:{port}")
+    return f"http://{host}:{port}"
+
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--tokens", default="data/tokens", help="token JSON folder")
+    parser.add_argument("--fixtures", help="recorded responses, see Stub")
+    parser.add_argument("--txs-per-day", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--rate-limit", type=int, help="requests per second")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(args):
+    return Stub(
+        load_tokens(args.tokens),
+        txs_per_day=args.txs_per_day,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+        fixtures=args.fixtures,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=Stub.__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    logger.info(f"serving stub on http://{args.host}:{args.port}")
+    web.run_app(from_arguments(args).app(), host=args.host, port=args.port, print=None)
@@ -3,11 +3,11 @@ import os
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from basel_framework import calculate_car
-from prices import collect_prices
 from snapshots import initialize_snapshots, update_snapshots
-from transfers import collect_transfers
+from workers import WorkerPool
 
 from data.base import Base, Session, engine
+from data.migrations import migrate
 from data.models import Assets, PriceSnapshot, Protocol, Token, TransferSnapshot
 
 # logger
@@ -46,6 +46,7 @@ def heartbeat():
 def initialize():
     logger.info("initializing database")
     Base.metadata.create_all(engine)
+    migrate(engine)
     initialize_snapshots()
 
 
@@ -53,8 +54,6 @@ def main():
     logger.info("initializing main loop")
     scheduler = BlockingScheduler(job_defaults={"timezone": "UTC"})
     scheduler.add_job(heartbeat, "interval", minutes=1)
-    scheduler.add_job(collect_prices, "interval", seconds=1)
-    scheduler.add_job(collect_transfers, "interval", seconds=1, max_instances=8)
     scheduler.add_job(update_snapshots, "cron", hour=0)
     scheduler.add_job(calculate_car, "cron", hour=1)
 
@@ -63,11 +62,14 @@ def main():
             "Break" if os.name == "nt" else "C"
         )
     )
+    workers = WorkerPool()
+    workers.start()
     try:
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         logger.info("terminating main loop")
         scheduler.shutdown()
+        workers.stop()
 
 
 if __name__ == "__main__":
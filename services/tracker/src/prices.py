@@ -1,14 +1,23 @@
 import json
 import logging
+import os
 import time
 
 import requests
-from joblib import Parallel, delayed
-from sqlalchemy import delete
-from sqlalchemy.dialects.postgresql import insert
+from basel_framework import invalidate_car
+from requests.utils import requote_uri
+from snapshots import (
+    claim_snapshots,
+    complete_snapshots,
+    release_snapshots,
+    renew_snapshots,
+)
+from sqlalchemy import func
 
-from data.base import Session
+from data.base import Session, engine
+from data.bulk import bulk_insert
 from data.models import Price, PriceSnapshot
+from data.partitions import create_partitions
 
 # logger
 logger = logging.getLogger(__file__)
@@ -21,19 +30,30 @@ sh.setFormatter(formatter)
 logger.addHandler(sh)
 
 # config
+DEFILLAMA_URL = os.getenv("DEFILLAMA_URL", "https://coins.llama.fi")
 RETRY_MAX = 5
 RETRY_BACKOFF = 0.2
-OFFSET = 50
+OFFSET = 2000  # snapshots claimed per batch
+URL_BUDGET = int(os.getenv("DEFILLAMA_URL_BUDGET", 6000))  # characters per request
+PRICE_BUDGET = int(os.getenv("DEFILLAMA_PRICE_BUDGET", 500))  # prices per request
+
 
+class RequestTooLarge(ConnectionError):
+    pass
 
-def query_defillama(endpoint):
+
+def query_defillama(http, endpoint):
     retries = 0
     while retries <= RETRY_MAX:
         try:
-            resp = requests.get("https://coins.llama.fi" + endpoint)
+            resp = http.get(DEFILLAMA_URL + endpoint)
             if resp.status_code == 200:
                 return resp.json()
+            if resp.status_code in (413, 414):
+                raise RequestTooLarge(f"request of {len(endpoint)} characters")
             raise resp.raise_for_status()
+        except RequestTooLarge:
+            raise
         except Exception as e:
             logger.debug(e)
             time.sleep(RETRY_BACKOFF * 2**retries)
@@ -41,79 +61,173 @@ def query_defillama(endpoint):
     raise ConnectionError("could not fetch data from DefiLlama")
 
 
-def _collect_prices(page):
+def get_first_changed(session, prices):
+    """Earliest timestamp whose daily price is affected by the new `prices`.
+
+    Prices are forward-filled, so the days since the previous price of a token
+    change as well.
+    """
+    timestamp = min(price.timestamp for price in prices)
+    previous = (
+        session.query(func.max(Price.timestamp).label("timestamp"))
+        .filter(Price.token_id.in_(set(price.token_id for price in prices)))
+        .filter(Price.timestamp < timestamp)
+        .group_by(Price.token_id)
+        .subquery()
+    )
+    previous = session.query(func.min(previous.c.timestamp)).scalar()
+    return timestamp if previous is None else previous
+
+
+def _encoded_length(text):
+    return len(requote_uri(text))
+
+
+def get_endpoint(snapshots):
+    query_batch = {}
+    for snapshot in snapshots:
+        key = f"ethereum:{snapshot.token_id}"
+        if key in query_batch:
+            query_batch[key].append(snapshot.timestamp)
+        else:
+            query_batch[key] = [snapshot.timestamp]
+
+    query_json = json.dumps(query_batch, separators=(",", ":"))
+    return f"/batchHistorical?coins={query_json}"
+
+
+def plan_requests(snapshots, url_budget=URL_BUDGET, price_budget=PRICE_BUDGET):
+    """Pack `snapshots` into as few batchHistorical requests as possible, each
+    with an encoded URL of at most `url_budget` characters and at most
+    `price_budget` requested prices."""
+
+    def added_length(snapshot, new_coin):
+        # the URL grows by the timestamp, and by the coin if it is new
+        length = _encoded_length(f",{snapshot.timestamp}")
+        if new_coin:
+            length += _encoded_length(f',"ethereum:{snapshot.token_id}":[]')
+        return length
+
+    empty_length = _encoded_length(get_endpoint([]))
+    batches = []
+    batch = []
+    coins = set()
+    length = empty_length
+    for snapshot in sorted(snapshots, key=lambda s: (s.token_id, s.timestamp)):
+        added = added_length(snapshot, snapshot.token_id not in coins)
+        if len(batch) > 0 and (
+            length + added > url_budget or len(batch) >= price_budget
+        ):
+            batches.append(batch)
+            batch = []
+            coins = set()
+            length = empty_length
+            added = added_length(snapshot, True)
+
+        batch.append(snapshot)
+        coins.add(snapshot.token_id)
+        length += added
+
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def parse_prices(data):
+    prices = []
+    for key, value in data.get("coins", {}).items():
+        token_id = key.split(":")[-1]
+        _prices = value.get("prices", [])
+        prices.extend(
+            [
+                {
+                    "token_id": token_id,
+                    "timestamp": _price["timestamp"],
+                    "value": _price["price"],
+                }
+                for _price in _prices
+            ]
+        )
+    return prices
+
+
+def store_prices(prices, snapshots):
+    create_partitions(
+        engine, Price.__tablename__, [price["timestamp"] for price in prices]
+    )
+    # store prices and remove snapshots in one transaction
     with Session() as session:
-        snapshots = (
-            session.query(PriceSnapshot)
-            .order_by(PriceSnapshot.token_id, PriceSnapshot.timestamp)
-            .offset(page * OFFSET)
-            .limit(OFFSET)
-            .all()
+        inserted = bulk_insert(
+            session,
+            Price,
+            prices,
+            index_elements=["token_id", "timestamp"],
+            returning=[Price.token_id, Price.timestamp],
         )
+        if len(inserted) > 0:
+            invalidate_car(session, get_first_changed(session, inserted))
+        complete_snapshots(session, PriceSnapshot, snapshots)
+        session.commit()
+
+
+def _collect_batch(http, snapshots):
+    """Collect the prices of one planned request. A request that is too large is
+    split in half and both halves are retried, down to single snapshots, which
+    are released back to the queue. Other connection errors are raised. Returns
+    the number of requests and prices."""
+    try:
+        data = query_defillama(http, get_endpoint(snapshots))
+    except RequestTooLarge as e:
+        if len(snapshots) == 1:
+            logger.error(f"skipping snapshot {snapshots[0]}: {e}")
+            release_snapshots(PriceSnapshot, snapshots)
+            return 1, 0
+        logger.warning(f"splitting request of {len(snapshots)} snapshots: {e}")
+        half = len(snapshots) // 2
+        requests_0, prices_0 = _collect_batch(http, snapshots[:half])
+        requests_1, prices_1 = _collect_batch(http, snapshots[half:])
+        return 1 + requests_0 + requests_1, prices_0 + prices_1
+
+    prices = parse_prices(data)
+    store_prices(prices, snapshots)
+    logger.debug(f"collected {len(prices)} prices for {len(snapshots)} snapshots")
+    return 1, len(prices)
+
+
+def _collect_prices(http):
+    snapshots = claim_snapshots(PriceSnapshot, OFFSET)
+    if len(snapshots) == 0:
+        return False
     logger.info(f"collecting prices for snapshots {snapshots[0]}-{snapshots[-1]}")
 
-    with Session() as session:
-        # collect snapshots
+    n_requests = 0
+    n_prices = 0
+    batches = plan_requests(snapshots)
+    for idx, batch in enumerate(batches):
+        remaining = [snapshot for batch in batches[idx:] for snapshot in batch]
+        if idx > 0:
+            renew_snapshots(PriceSnapshot, remaining)
         try:
-            query_batch = {}
-            for snapshot in snapshots:
-                key = f"ethereum:{snapshot.token_id}"
-                if key in query_batch:
-                    query_batch[key].append(snapshot.timestamp)
-                else:
-                    query_batch[key] = [snapshot.timestamp]
-
-            query_json = json.dumps(query_batch)
-            data = query_defillama(f"/batchHistorical?coins={query_json}")
-
-            prices = []
-            for key, value in data.get("coins", {}).items():
-                token_id = key.split(":")[-1]
-                _prices = value.get("prices", [])
-                prices.extend(
-                    [
-                        {
-                            "token_id": token_id,
-                            "timestamp": _price["timestamp"],
-                            "value": _price["price"],
-                        }
-                        for _price in _prices
-                    ]
-                )
-
-            if len(prices) > 0:
-                stmt = (
-                    insert(Price)
-                    .values(prices)
-                    .on_conflict_do_nothing(index_elements=["token_id", "timestamp"])
-                )
-                session.execute(stmt)
-                session.commit()
-
-        except ConnectionError:
-            logger.error(
-                f"skipping snapshots {snapshots[0]}-{snapshots[-1]} due to connection error"
-            )
-            return
-
-        # remove snapshots
-        for snapshot in snapshots:
-            stmt = delete(PriceSnapshot).filter(
-                PriceSnapshot.token_id == snapshot.token_id,
-                PriceSnapshot.timestamp == snapshot.timestamp,
-            )
-            session.execute(stmt)
-            session.commit()
-
-
-def collect_prices():
-    with Session() as session:
-        rows = session.query(PriceSnapshot).count()
-    if rows == 0:
-        return
-
-    pages = rows // OFFSET + (rows % OFFSET > 0)
-    pages = min(pages, 8)
-    Parallel(backend="loky", n_jobs=pages)(
-        [delayed(_collect_prices)(page) for page in range(pages)]
+            _requests, _prices = _collect_batch(http, batch)
+        except ConnectionError as e:
+            # DefiLlama is down, retry the rest of the claim later
+            logger.error(f"releasing {len(remaining)} snapshots: {e}")
+            release_snapshots(PriceSnapshot, remaining)
+            n_requests += 1
+            break
+        n_requests += _requests
+        n_prices += _prices
+    logger.info(
+        f"collected {n_prices} prices for {len(snapshots)} snapshots in "
+        f"{n_requests} requests ({n_prices / n_requests:.1f} prices per request)"
     )
+    return True
+
+
+def collect_prices(http=None):
+    """Collect one batch of price snapshots, over `http` if given. Returns False
+    if the queue was empty."""
+    if http is None:
+        with requests.Session() as http:
+            return _collect_prices(http)
+    return _collect_prices(http)
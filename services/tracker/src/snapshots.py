@@ -3,7 +3,23 @@ import logging
 import os
 import time
 
+from basel_framework.utils import invalidate_registry
 from joblib import Parallel, delayed
+from sqlalchemy import (
+    Integer,
+    cast,
+    column,
+    delete,
+    func,
+    literal,
+    or_,
+    select,
+    true,
+    tuple_,
+    union,
+    update,
+    values,
+)
 from sqlalchemy.dialects.postgresql import insert
 
 from data.base import Session
@@ -31,6 +47,189 @@ logger.addHandler(sh)
 MIN_TIMESTAMP = 1534377600  # 2018-Aug-16
 INTERVAL = 60 * 60 * 24  # daily
 OFFSET = 100000
+LEASE_DURATION = 10 * 60  # seconds a claimed snapshot is reserved for a worker
+RETRY_MAX = 5  # failed attempts before a snapshot is dropped from the queue
+RETRY_DELAY = 60  # seconds, doubled with every failed attempt
+SEGMENT_DURATION = 90 * INTERVAL  # initial backfill range of a transfer snapshot
+
+
+def _now():
+    return cast(func.extract("epoch", func.now()), Integer)
+
+
+def _key(model, snapshots):
+    """Primary key tuple of `model` and its values for `snapshots`."""
+    columns = list(model.__table__.primary_key.columns)
+    values = [
+        tuple(getattr(snapshot, column.key) for column in columns)
+        for snapshot in snapshots
+    ]
+    return tuple_(*columns), values
+
+
+def select_claimable(model, limit):
+    """Query of the keys of the next `limit` claimable snapshots of `model`."""
+    columns = list(model.__table__.primary_key.columns)
+    return (
+        select(*columns)
+        .where(or_(model.leased_until.is_(None), model.leased_until < _now()))
+        .where(model.retries < RETRY_MAX)
+        .order_by(model.priority.desc(), *columns)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def claim_snapshots(model, limit):
+    """Lease up to `limit` snapshots of `model` (TransferSnapshot or PriceSnapshot)
+    to the caller, highest priority first.
+
+    Claiming skips rows locked by other workers, so any number of workers and
+    processes can share the queue. A snapshot stays in the queue until it is
+    completed, and becomes claimable again once its lease expires.
+    """
+    columns = list(model.__table__.primary_key.columns)
+    claimable = select_claimable(model, limit)
+    stmt = (
+        update(model)
+        .where(tuple_(*columns).in_(claimable))
+        .values(leased_until=_now() + LEASE_DURATION)
+        .returning(model)
+        .execution_options(synchronize_session=False)
+    )
+    with Session() as session:
+        snapshots = session.scalars(stmt).all()
+        session.expunge_all()
+        session.commit()
+    return snapshots
+
+
+def renew_snapshots(model, snapshots):
+    """Extend the leases of `snapshots` that are still being worked on."""
+    key, values = _key(model, snapshots)
+    with Session() as session:
+        stmt = (
+            update(model)
+            .where(key.in_(values))
+            .values(leased_until=_now() + LEASE_DURATION)
+        )
+        session.execute(stmt)
+        session.commit()
+
+
+def complete_snapshots(session, model, snapshots):
+    """Remove `snapshots` from the queue within the transaction of `session`, with
+    a single `DELETE ... USING (VALUES ...)`."""
+    key, rows = _key(model, snapshots)
+    completed = values(
+        *[column(c.key, c.type) for c in key.clauses], name="completed"
+    ).data(rows)
+    stmt = delete(model).where(*[c == completed.c[c.key] for c in key.clauses])
+    session.execute(stmt)
+
+
+def checkpoint_snapshot(snapshot, block):
+    """Record that the transfers of `snapshot` are stored up to `block` and extend
+    its lease."""
+    key, values = _key(TransferSnapshot, [snapshot])
+    with Session() as session:
+        stmt = (
+            update(TransferSnapshot)
+            .where(key.in_(values))
+            .values(checkpoint=block, leased_until=_now() + LEASE_DURATION)
+        )
+        session.execute(stmt)
+        session.commit()
+    snapshot.checkpoint = block
+
+
+def split_snapshot(snapshot, timestamps):
+    """Shorten the leased `snapshot` to end at `timestamps[0]` and queue the rest of
+    its range as new snapshots between the following `timestamps`, so that other
+    workers can collect them in parallel.
+
+    The end is part of the primary key, so the segments are inserted next to the
+    original row, skipping existing ones, and the original row is deleted. The
+    shortened segment keeps the lease, retries and checkpoint of the original."""
+    key, values = _key(TransferSnapshot, [snapshot])
+    bounds = [*timestamps, snapshot.to_timestamp]
+    index_elements = ["treasury_id", "from_timestamp", "to_timestamp"]
+    with Session() as session:
+        shortened = select(
+            TransferSnapshot.treasury_id,
+            TransferSnapshot.from_timestamp,
+            literal(timestamps[0]),
+            TransferSnapshot.priority,
+            TransferSnapshot.retries,
+            TransferSnapshot.leased_until,
+            TransferSnapshot.checkpoint,
+        ).where(key.in_(values))
+        stmt = (
+            insert(TransferSnapshot)
+            .from_select(
+                [
+                    *index_elements,
+                    "priority",
+                    "retries",
+                    "leased_until",
+                    "checkpoint",
+                ],
+                shortened,
+            )
+            .on_conflict_do_nothing(index_elements=index_elements)
+        )
+        session.execute(stmt)
+        stmt = (
+            insert(TransferSnapshot)
+            .values(
+                [
+                    {
+                        "treasury_id": snapshot.treasury_id,
+                        "from_timestamp": start,
+                        "to_timestamp": end,
+                        "priority": snapshot.priority,
+                    }
+                    for start, end in zip(bounds[:-1], bounds[1:])
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=index_elements)
+        )
+        session.execute(stmt)
+        stmt = (
+            delete(TransferSnapshot)
+            .where(key.in_(values))
+            .execution_options(synchronize_session=False)
+        )
+        session.execute(stmt)
+        session.commit()
+    snapshot.to_timestamp = timestamps[0]
+
+
+def release_snapshots(model, snapshots):
+    """Return failed `snapshots` to the queue, to be retried after a backoff.
+
+    Snapshots that failed RETRY_MAX times are dropped from the queue instead, so
+    that the daily check queues them again with a fresh retry count.
+    """
+    key, values = _key(model, snapshots)
+    backoff = cast(RETRY_DELAY * func.power(2, model.retries), Integer)
+    with Session() as session:
+        stmt = (
+            delete(model)
+            .where(key.in_(values))
+            .where(model.retries + 1 >= RETRY_MAX)
+            .returning(model)
+            .execution_options(synchronize_session=False)
+        )
+        for snapshot in session.scalars(stmt):
+            logger.error(f"dropping snapshot {snapshot} after {RETRY_MAX} attempts")
+        stmt = (
+            update(model)
+            .where(key.in_(values))
+            .values(retries=model.retries + 1, leased_until=_now() + backoff)
+        )
+        session.execute(stmt)
+        session.commit()
 
 
 def update_protocols():
@@ -90,6 +289,7 @@ def update_protocols():
             session.execute(stmt)
             session.commit()
 
+    invalidate_registry()
     logger.debug("updating protocols complete")
 
 
@@ -132,6 +332,7 @@ def update_tokens():
             session.execute(stmt)
             session.commit()
 
+    invalidate_registry()
     logger.debug("updating tokens complete")
 
 
@@ -145,128 +346,132 @@ def create_timestamps():
     return timestamps
 
 
+def select_missing_transfers(timestamps):
+    """Query of the (treasury, day) pairs between the first and the last of
+    `timestamps` on which the treasury has no transfers."""
+    # days on which a treasury sent or received a transfer
+    day = Transfer.timestamp - Transfer.timestamp % INTERVAL
+    in_range = (Transfer.timestamp >= timestamps[0]) & (
+        Transfer.timestamp < timestamps[-1]
+    )
+    active = union(
+        select(Transfer.from_address.label("address"), day.label("day"))
+        .where(in_range)
+        .where(Transfer.from_address.in_(select(Treasury.id))),
+        select(Transfer.to_address.label("address"), day.label("day"))
+        .where(in_range)
+        .where(Transfer.to_address.in_(select(Treasury.id))),
+    ).subquery("active")
+
+    # all other (treasury, day) pairs are missing
+    days = (
+        func.generate_series(timestamps[0], timestamps[-1] - INTERVAL, INTERVAL)
+        .table_valued("day")
+        .render_derived("days")
+    )
+    return (
+        select(Treasury.id, days.c.day, days.c.day + INTERVAL)
+        .join(days, true())
+        .outerjoin(
+            active, (active.c.address == Treasury.id) & (active.c.day == days.c.day)
+        )
+        .where(active.c.address.is_(None))
+    )
+
+
 def check_transfers(timestamps):
     logger.debug(f"checking transfers for {len(timestamps)} timestamps")
 
-    with Session() as session:
-        treasuries = session.query(Treasury).all()
-        idx = 1
-        snapshots = []
-        while idx < len(timestamps):
-            start = timestamps[idx - 1]
-            end = timestamps[idx]
-            idx += 1
-
-            tx_ts = session.query(Transfer).filter(
-                Transfer.timestamp >= start, Transfer.timestamp < end
-            )
-            for treasury in treasuries:
-                tx_cnt = tx_ts.filter(
-                    (Transfer.from_address == treasury.id)
-                    | (Transfer.to_address == treasury.id)
-                ).first()
-                if tx_cnt is None:
-                    snapshots.append(
-                        {
-                            "treasury_id": treasury.id,
-                            "from_timestamp": start,
-                            "to_timestamp": end,
-                        }
-                    )
-            if len(snapshots) > OFFSET:
-                logger.debug(
-                    f"adding {len(snapshots)} snapshots for transfers {idx}/{len(timestamps) - 1}"
-                )
-                stmt = (
-                    insert(TransferSnapshot)
-                    .values(snapshots)
-                    .on_conflict_do_nothing(
-                        index_elements=["treasury_id", "from_timestamp", "to_timestamp"]
-                    )
-                )
-                session.execute(stmt)
-                session.commit()
-                snapshots = []
+    if len(timestamps) < 2:
+        return
 
-        if len(snapshots) > 0:
-            logger.debug(
-                f"adding {len(snapshots)} snapshots for transfers {len(timestamps) - 1}/{len(timestamps) - 1}"
-            )
-            stmt = (
-                insert(TransferSnapshot)
-                .values(snapshots)
-                .on_conflict_do_nothing(
-                    index_elements=["treasury_id", "from_timestamp", "to_timestamp"]
-                )
+    missing = select_missing_transfers(timestamps)
+    with Session() as session:
+        stmt = (
+            insert(TransferSnapshot)
+            .from_select(["treasury_id", "from_timestamp", "to_timestamp"], missing)
+            .on_conflict_do_nothing(
+                index_elements=["treasury_id", "from_timestamp", "to_timestamp"]
             )
-            session.execute(stmt)
-            session.commit()
+        )
+        result = session.execute(stmt)
+        session.commit()
+        logger.debug(f"added {result.rowcount} snapshots for transfers")
 
     logger.debug("checking transfers complete")
 
 
-def check_prices(timestamps):
-    logger.debug(f"checking prices for {len(timestamps)} timestamps")
+def select_missing_prices(timestamps, tokens=None):
+    """Query of the (token, timestamp) pairs after the first of `timestamps`
+    without a price, for all tokens or the given `tokens`."""
+    # the constant range lets the planner skip the other partitions of prices
+    in_range = Price.timestamp.between(timestamps[1], timestamps[-1])
+    timestamps = (
+        func.generate_series(timestamps[1], timestamps[-1], INTERVAL)
+        .table_valued("timestamp")
+        .render_derived("timestamps")
+    )
+    missing = (
+        select(Token.id, timestamps.c.timestamp)
+        .join(timestamps, true())
+        .outerjoin(
+            Price,
+            (Price.token_id == Token.id)
+            & (Price.timestamp == timestamps.c.timestamp)
+            & in_range,
+        )
+        .where(Price.token_id.is_(None))
+    )
+    if tokens is not None:
+        missing = missing.where(Token.id.in_(tokens))
+    return missing
 
-    with Session() as session:
-        tokens = session.query(Token).all()
-        idx = 1
-        snapshots = []
-        while idx < len(timestamps):
-            ts = timestamps[idx]
-            idx += 1
 
-            prices_ts = session.query(Price).filter(Price.timestamp == ts)
-            for token in tokens:
-                prices_token = prices_ts.filter(Price.token_id == token.id).first()
-                if prices_token is None:
-                    snapshots.append(
-                        {
-                            "token_id": token.id,
-                            "timestamp": ts,
-                        }
-                    )
-            if len(snapshots) > OFFSET:
-                logger.debug(
-                    f"adding {len(snapshots)} snapshots for prices {idx}/{len(timestamps) - 1}"
-                )
-                stmt = (
-                    insert(PriceSnapshot)
-                    .values(snapshots)
-                    .on_conflict_do_nothing(index_elements=["token_id", "timestamp"])
-                )
-                session.execute(stmt)
-                session.commit()
-                snapshots = []
+def check_prices(timestamps, tokens=None):
+    """Add a price snapshot for every token and timestamp without a price.
 
-        if len(snapshots) > 0:
-            logger.debug(
-                f"adding {len(snapshots)} snapshots for prices {len(timestamps) - 1}/{len(timestamps) - 1}"
-            )
-            stmt = (
-                insert(PriceSnapshot)
-                .values(snapshots)
-                .on_conflict_do_nothing(index_elements=["token_id", "timestamp"])
-            )
-            session.execute(stmt)
-            session.commit()
+    Only the tokens in `tokens` are checked if given, e.g. after adding a token.
+    """
+    logger.debug(f"checking prices for {len(timestamps)} timestamps")
+
+    if len(timestamps) < 2:
+        return
+
+    missing = select_missing_prices(timestamps, tokens)
+    with Session() as session:
+        stmt = (
+            insert(PriceSnapshot)
+            .from_select(["token_id", "timestamp"], missing)
+            .on_conflict_do_nothing(index_elements=["token_id", "timestamp"])
+        )
+        result = session.execute(stmt)
+        session.commit()
+        logger.debug(f"added {result.rowcount} snapshots for prices")
 
     logger.debug("checking prices complete")
 
 
 def init_transfers(timestamps):
+    """Queue the history of every treasury as snapshots of SEGMENT_DURATION, which
+    the transfer workers collect in parallel and split further when busy."""
     logger.debug(f"initializing transfers for {len(timestamps)} timestamps")
 
+    step = SEGMENT_DURATION // INTERVAL
+    bounds = timestamps[::step]
+    if bounds[-1] != timestamps[-1]:
+        bounds.append(timestamps[-1])
+
     with Session() as session:
         treasuries = session.query(Treasury).all()
 
         snapshots = [
             {
                 "treasury_id": treasury.id,
-                "from_timestamp": timestamps[0],
-                "to_timestamp": timestamps[-1],
+                "from_timestamp": start,
+                "to_timestamp": end,
             }
             for treasury in treasuries
+            for start, end in zip(bounds[:-1], bounds[1:])
         ]
 
         logger.debug(
@@ -1,15 +1,29 @@
-import hashlib
+import asyncio
+import codecs
+import functools
+import json
 import logging
 import os
-import time
+import re
 
-import requests
-from sqlalchemy import delete
+import aiohttp
+from basel_framework import invalidate_car
+from basel_framework.utils import add_daily_flows
+from snapshots import (
+    INTERVAL,
+    checkpoint_snapshot,
+    claim_snapshots,
+    complete_snapshots,
+    release_snapshots,
+    renew_snapshots,
+    split_snapshot,
+)
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.orm import make_transient
 
-from data.base import Session
-from data.models import Token, Transfer, TransferSnapshot
+from data.base import Session, engine
+from data.bulk import bulk_insert
+from data.models import Block, Token, Transfer, TransferSnapshot
+from data.partitions import create_partitions
 
 # logger
 logger = logging.getLogger(__file__)
@@ -22,133 +36,466 @@ sh.setFormatter(formatter)
 logger.addHandler(sh)
 
 # config
+ETHERSCAN_URL = os.getenv("ETHERSCAN_URL", "https://api.etherscan.io/api")
 RETRY_MAX = 5
 RETRY_BACKOFF = 0.2
+RATE_LIMIT = float(os.getenv("ETHERSCAN_RATE_LIMIT", 5))  # requests per second
+CONCURRENCY = int(os.getenv("ETHERSCAN_CONCURRENCY", 8))  # snapshots in flight
+BATCH_SIZE = 64  # snapshots per run
+LEASE_RENEWAL = 60  # seconds between lease renewals of the snapshots of a run
+PAGE_SIZE = 10000
+CHUNK_SIZE = 64 * 1024  # bytes of a tokentx page parsed at once
+COPY_SIZE = 2000  # transfers stored at once
+BLOCK_TOLERANCE = 15 * 60  # seconds a known block may be off before refining
+SEGMENT_PAGES = 4  # tokentx pages a worker collects before splitting a snapshot
+RESULT_ARRAY = re.compile(r'"result"\s*:\s*\[')
+TX_HASH = re.compile(r"0x[0-9a-fA-F]{64}")
+
+
+class RateLimiter:
+    """Spaces out requests shared by many coroutines to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
 
+class EtherscanError(ConnectionError):
+    pass
+
+
+class TransactionError(ValueError):
+    """Malformed transaction in a tokentx page, which fails again on every retry."""
+
+
+def check_status(data):
+    if data.get("status") == "1" or data.get("message") == "No transactions found":
+        return
+    raise EtherscanError(data.get("result"))
 
-def query_etherscan(params):
+
+async def read_result(resp):
+    data = await resp.json(content_type=None)
+    check_status(data)
+    return data["result"]
+
+
+async def query_etherscan(http, limiter, params, read=read_result):
+    """Request `params` from Etherscan and `read` the response, retrying failed
+    requests and API errors. Errors raised while storing or parsing the result
+    in `read` are passed on as is."""
     retries = 0
     while retries <= RETRY_MAX:
         try:
-            resp = requests.get("https://api.etherscan.io/api", params=params)
-            data = resp.json()
-            if data["status"] == "1" or data["message"] == "No transactions found":
-                return data["result"]
-            else:
-                raise ConnectionError(data["result"])
-        except Exception as e:
+            await limiter.wait()
+            async with http.get(ETHERSCAN_URL, params=params) as resp:
+                return await read(resp)
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            json.JSONDecodeError,  # e.g. an HTML error page
+            EtherscanError,
+        ) as e:
             logger.debug(e)
-            time.sleep(RETRY_BACKOFF * 2**retries)
+            await asyncio.sleep(RETRY_BACKOFF * 2**retries)
             retries += 1
     raise ConnectionError("could not fetch data from Etherscan")
 
 
-def get_block_number(timestamp):
+async def get_block_number(http, limiter, timestamp):
     params = {
         "module": "block",
         "action": "getblocknobytime",
         "timestamp": timestamp,
         "closest": "before",
-        "apikey": os.getenv("ETHERSCAN_TOKEN"),
+        "apikey": os.getenv("ETHERSCAN_TOKEN", ""),
     }
-    return query_etherscan(params)
+    return await query_etherscan(http, limiter, params)
+
+
+def find_block(timestamp, closest):
+    with Session() as session:
+        if closest == "before":
+            block = (
+                session.query(Block)
+                .filter(Block.timestamp <= timestamp)
+                .order_by(Block.timestamp.desc())
+                .first()
+            )
+        else:
+            block = (
+                session.query(Block)
+                .filter(Block.timestamp >= timestamp)
+                .order_by(Block.timestamp)
+                .first()
+            )
+    if block is None or abs(block.timestamp - timestamp) > BLOCK_TOLERANCE:
+        return None
+    return block.number
+
+
+def store_block(timestamp, number):
+    with Session() as session:
+        stmt = (
+            insert(Block)
+            .values(timestamp=timestamp, number=number)
+            .on_conflict_do_nothing(index_elements=["timestamp"])
+        )
+        session.execute(stmt)
+        session.commit()
+
+
+class BlockIndex:
+    """Block numbers by timestamp, backed by the blocks table.
+
+    Snapshots share the timestamps of the daily grid, so each of them is only
+    resolved with Etherscan once. Other timestamps are answered with the closest
+    known block before (a lower bound) or after (an upper bound) if it is within
+    `BLOCK_TOLERANCE`, and are resolved and added to the index otherwise.
+    """
+
+    def __init__(self, http, limiter):
+        self.http = http
+        self.limiter = limiter
+        self._pending = {}
+
+    async def get(self, timestamp, closest="before"):
+        number = await asyncio.to_thread(find_block, timestamp, closest)
+        if number is not None:
+            return number
+
+        # concurrent snapshots usually ask for the same timestamp
+        if timestamp not in self._pending:
+            self._pending[timestamp] = asyncio.create_task(self._resolve(timestamp))
+        try:
+            return await self._pending[timestamp]
+        finally:
+            self._pending.pop(timestamp, None)
 
+    async def _resolve(self, timestamp):
+        number = int(await get_block_number(self.http, self.limiter, timestamp))
+        await asyncio.to_thread(store_block, timestamp, number)
+        return number
+
+
+async def iter_result(resp):
+    """Yield the objects of the `result` array of an Etherscan response as they
+    arrive, without holding the whole response in memory."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    head = None
+    in_result = False
+    after_result = False
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        buffer += text.decode(chunk)
+        if after_result:
+            continue
+        if not in_result:
+            match = RESULT_ARRAY.search(buffer)
+            if match is None:
+                continue
+            head = json.loads(buffer[: match.start()].rstrip(", ") + "}")
+            # status and message usually precede the result, otherwise they are
+            # checked once the rest of the response is read
+            if "status" in head:
+                check_status(head)
+            buffer = buffer[match.end() :]
+            in_result = True
+
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == "]":
+                after_result = True
+                pos += 1
+                break
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the object continues in the next chunk
+                break
+            yield obj
+        buffer = buffer[pos:]
+
+    buffer += text.decode(b"", final=True)
+    if not in_result:
+        # errors carry a message instead of an array
+        check_status(json.loads(buffer))
+    elif "status" not in head:
+        tail = json.loads("{" + buffer.strip().lstrip(","))
+        check_status({**head, **tail})
+
+
+def parse_integer(tx, field):
+    value = tx.get(field)
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = -1
+    if number < 0:
+        raise TransactionError(
+            f"invalid {field} {value!r} of transaction {tx.get('hash')!r}"
+        )
+    return number
+
+
+def parse_transaction(tx, decimals):
+    """Row of the transfers table for `tx`. Raises TransactionError if the natural
+    key or the value of `tx` is malformed."""
+    tx_hash = tx.get("hash")
+    if not isinstance(tx_hash, str) or TX_HASH.fullmatch(tx_hash) is None:
+        raise TransactionError(f"invalid hash {tx_hash!r}")
+    return {
+        "tx_hash": bytes.fromhex(tx_hash[2:]),
+        "log_index": parse_integer(tx, "logIndex"),
+        "token_id": tx["contractAddress"],
+        "timestamp": parse_integer(tx, "timeStamp"),
+        "block_number": parse_integer(tx, "blockNumber"),
+        "from_address": tx["from"],
+        "to_address": tx["to"],
+        "value": tx["value"],
+        "amount": parse_integer(tx, "value") / 10**decimals,
+    }
 
-def get_transactions(address, from_block, to_block):
+
+async def store_page(tokens, resp):
+    """Stream a tokentx page into the transfers table, COPY_SIZE rows at a time.
+    Returns the number of transactions on the page and the block number and
+    timestamp of the last one.
+
+    Malformed transactions are logged and skipped, a full page without any valid
+    block number raises TransactionError as it cannot be paginated."""
+    count = 0
+    last_block = None
+    last_timestamp = None
+    txs = []
+    stored = None
+    async for tx in iter_result(resp):
+        count += 1
+        try:
+            if tx.get("contractAddress") in tokens:
+                txs.append(parse_transaction(tx, tokens[tx["contractAddress"]]))
+            block = parse_integer(tx, "blockNumber")
+            timestamp = parse_integer(tx, "timeStamp")
+        except TransactionError as e:
+            logger.error(f"skipping transaction: {e}")
+            continue
+        last_block = block
+        last_timestamp = timestamp
+        if len(txs) >= COPY_SIZE:
+            # store a chunk while the next one is parsed
+            if stored is not None:
+                await stored
+            stored = asyncio.create_task(asyncio.to_thread(store_transactions, txs))
+            txs = []
+
+    if stored is not None:
+        await stored
+    if len(txs) > 0:
+        await asyncio.to_thread(store_transactions, txs)
+    if count >= PAGE_SIZE and last_block is None:
+        raise TransactionError("no valid transaction on a full page")
+    return count, last_block, last_timestamp
+
+
+async def get_transactions(http, limiter, tokens, address, from_block, to_block):
     params = {
         "module": "account",
         "action": "tokentx",
         "address": address,
-        "offset": 10000,
+        "offset": PAGE_SIZE,
         "startblock": from_block,
         "endblock": to_block,
         "sort": "asc",
-        "apikey": os.getenv("ETHERSCAN_TOKEN"),
+        "apikey": os.getenv("ETHERSCAN_TOKEN", ""),
     }
-    return query_etherscan(params)
+    return await query_etherscan(
+        http, limiter, params, functools.partial(store_page, tokens)
+    )
 
 
-def _collect_transfers():
+def store_transactions(txs):
+    create_partitions(engine, Transfer.__tablename__, [tx["timestamp"] for tx in txs])
     with Session() as session:
-        tokens = session.query(Token.id).all()
-        tokens = set(token[0] for token in tokens)
-        snapshot = (
-            session.query(TransferSnapshot)
-            .order_by(
-                TransferSnapshot.treasury_id,
-                TransferSnapshot.from_timestamp,
-                TransferSnapshot.to_timestamp,
-            )
-            .first()
+        inserted = bulk_insert(
+            session,
+            Transfer,
+            txs,
+            index_elements=["tx_hash", "log_index", "token_id", "timestamp"],
+            returning=[
+                Transfer.timestamp,
+                Transfer.from_address,
+                Transfer.to_address,
+                Transfer.token_id,
+                Transfer.value,
+            ],
         )
-        # remove snapshot
-        logger.info(f"collecting txs for snapshot {snapshot}")
-        stmt = delete(TransferSnapshot).filter(
-            TransferSnapshot.treasury_id == snapshot.treasury_id,
-            TransferSnapshot.from_timestamp == snapshot.from_timestamp,
-            TransferSnapshot.to_timestamp == snapshot.to_timestamp,
+        if len(inserted) > 0:
+            add_daily_flows(session, inserted)
+            addresses = set(tx.from_address for tx in inserted)
+            addresses |= set(tx.to_address for tx in inserted)
+            invalidate_car(session, min(tx.timestamp for tx in inserted), addresses)
+        session.commit()
+
+
+def plan_split(snapshot, start, end):
+    """Boundaries to split off the rest of `snapshot` after a full page of
+    transfers between the timestamps `start` and `end`, or None if the rest is
+    expected to take at most SEGMENT_PAGES pages."""
+    pages = (snapshot.to_timestamp - end) / max(end - start, 1)
+    if pages <= SEGMENT_PAGES:
+        return None
+
+    duration = max(int((end - start) * SEGMENT_PAGES) // INTERVAL * INTERVAL, INTERVAL)
+    split = (end // INTERVAL + 1) * INTERVAL
+    timestamps = list(range(split, snapshot.to_timestamp, duration))
+    return timestamps if len(timestamps) > 0 else None
+
+
+async def _collect_transfers(http, limiter, blocks, tokens, snapshot):
+    logger.info(f"collecting txs for snapshot {snapshot}")
+
+    from_block, to_block = await asyncio.gather(
+        blocks.get(snapshot.from_timestamp, "before"),
+        blocks.get(snapshot.to_timestamp, "after"),
+    )
+    # resume after the pages stored by an earlier attempt
+    if snapshot.checkpoint is not None:
+        from_block = max(from_block, snapshot.checkpoint)
+    start = snapshot.from_timestamp
+    is_last_page = False
+    while not is_last_page:
+        count, last_block, last_timestamp = await get_transactions(
+            http, limiter, tokens, snapshot.treasury_id, from_block, to_block
         )
-        session.execute(stmt)
+        logger.debug(f"collected {count} txs for snapshot {snapshot}")
+        is_last_page = count < PAGE_SIZE
+        if is_last_page:
+            break
+
+        # the last block may continue on the next page
+        from_block = last_block
+        await asyncio.to_thread(checkpoint_snapshot, snapshot, from_block)
+
+        # hand the rest of a busy snapshot to other workers
+        timestamps = plan_split(snapshot, start, last_timestamp)
+        if timestamps is not None:
+            logger.info(
+                f"splitting snapshot {snapshot} into {len(timestamps) + 1} snapshots"
+            )
+            await asyncio.to_thread(split_snapshot, snapshot, timestamps)
+            to_block = await blocks.get(snapshot.to_timestamp, "after")
+        start = last_timestamp
+
+
+def complete_snapshot(snapshot):
+    with Session() as session:
+        complete_snapshots(session, TransferSnapshot, [snapshot])
         session.commit()
 
+
+def get_tokens():
+    """Decimals of the tracked tokens by token id."""
     with Session() as session:
-        # collect snapshot
-        try:
-            from_block = get_block_number(snapshot.from_timestamp)
-            to_block = get_block_number(snapshot.to_timestamp)
-            is_last_page = False
-            while not is_last_page:
-                data = get_transactions(snapshot.treasury_id, from_block, to_block)
-                is_last_page = len(data) < 10000
-                if not is_last_page:
-                    from_block = data[-1]["blockNumber"]
-
-                txs = [
-                    {
-                        "block_hash": tx["blockHash"],
-                        "tx_hash": tx["hash"],
-                        "log_index": tx["transactionIndex"],
-                        "timestamp": tx["timeStamp"],
-                        "block_number": int(tx["blockNumber"]),
-                        "token_id": tx["contractAddress"],
-                        "from_address": tx["from"],
-                        "to_address": tx["to"],
-                        "value": tx["value"],
-                    }
-                    for tx in data
-                    if tx["contractAddress"] in tokens
-                ]
-                for tx in txs:
-                    tx_str = str(tx).encode("utf-8")
-                    tx["id"] = hashlib.md5(tx_str).hexdigest()
-                    del tx["block_hash"]
-                    del tx["tx_hash"]
-                    del tx["log_index"]
-
-                if len(txs) == 0:
-                    continue
-
-                logger.debug(f"collecting {len(txs)} txs for snapshot {snapshot}")
-                stmt = (
-                    insert(Transfer)
-                    .values(txs)
-                    .on_conflict_do_nothing(index_elements=["id"])
+        tokens = session.query(Token.id, Token.decimals).all()
+    return dict(tokens)
+
+
+class TransferCollector:
+    """Collects claimed transfer snapshots over one pooled HTTP session.
+
+    The ingestion workers keep a collector open, so that its connections, rate
+    limit and block index carry over from one batch to the next.
+    """
+
+    async def open(self):
+        self.limiter = RateLimiter(RATE_LIMIT)
+        self.semaphore = asyncio.Semaphore(CONCURRENCY)
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONCURRENCY)
+        )
+        self.blocks = BlockIndex(self.http, self.limiter)
+
+    async def close(self):
+        await self.http.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _collect(self, tokens, snapshot, pending):
+        async with self.semaphore:
+            try:
+                await _collect_transfers(
+                    self.http, self.limiter, self.blocks, tokens, snapshot
+                )
+                await asyncio.to_thread(complete_snapshot, snapshot)
+                return None
+            except ConnectionError:
+                logger.error(f"skipping snapshot {snapshot} due to connection error")
+                return snapshot
+            except TransactionError as e:
+                # retrying would fail on the same page, the daily check queues it again
+                logger.error(f"dropping snapshot {snapshot}: {e}")
+                await asyncio.to_thread(complete_snapshot, snapshot)
+                return None
+            finally:
+                pending.discard(snapshot)
+
+    async def _renew(self, pending):
+        """Keep the leases of the `pending` snapshots of a run, including the ones
+        still waiting for a free slot."""
+        while True:
+            await asyncio.sleep(LEASE_RENEWAL)
+            if len(pending) > 0:
+                await asyncio.to_thread(
+                    renew_snapshots, TransferSnapshot, list(pending)
                 )
-                session.execute(stmt)
-                session.commit()
 
-        # add snapshot back in
-        except ConnectionError:
-            make_transient(snapshot)
-            session.add(snapshot)
-            session.commit()
-            logger.error(f"skipping snapshot {snapshot} due to connection error")
+    async def collect(self):
+        """Collect one batch of snapshots. Returns False if the queue was empty."""
+        snapshots = await asyncio.to_thread(
+            claim_snapshots, TransferSnapshot, BATCH_SIZE
+        )
+        if len(snapshots) == 0:
+            return False
+
+        tokens = await asyncio.to_thread(get_tokens)
+        pending = set(snapshots)
+        renewal = asyncio.create_task(self._renew(pending))
+        try:
+            failed = await asyncio.gather(
+                *[self._collect(tokens, snapshot, pending) for snapshot in snapshots]
+            )
+        finally:
+            renewal.cancel()
+
+        # retry failed snapshots later
+        failed = [snapshot for snapshot in failed if snapshot is not None]
+        if len(failed) > 0:
+            await asyncio.to_thread(release_snapshots, TransferSnapshot, failed)
+        return True
 
 
 def collect_transfers():
-    with Session() as session:
-        rows = session.query(TransferSnapshot).count()
-    if rows == 0:
-        return
+    async def collect():
+        async with TransferCollector() as collector:
+            return await collector.collect()
 
-    _collect_transfers()
+    return asyncio.run(collect())
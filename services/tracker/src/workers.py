@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import threading
+
+import requests
+from prices import collect_prices
+from transfers import TransferCollector
+
+# logger
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)s - %(message)s"
+)
+sh = logging.StreamHandler()
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+# config
+PRICE_WORKERS = int(os.getenv("DEFILLAMA_CONCURRENCY", 8))
+IDLE_BACKOFF = 1  # seconds
+IDLE_BACKOFF_MAX = 60  # seconds
+
+
+def run_worker(name, work, stop):
+    """Call `work` until `stop` is set. While `work` reports an empty queue, wait
+    with an exponential backoff before polling again."""
+    logger.debug(f"starting worker {name}")
+    backoff = IDLE_BACKOFF
+    while not stop.is_set():
+        try:
+            busy = work()
+        except Exception:
+            logger.exception(f"worker {name} failed")
+            busy = False
+
+        if busy:
+            backoff = IDLE_BACKOFF
+        else:
+            stop.wait(backoff)
+            backoff = min(backoff * 2, IDLE_BACKOFF_MAX)
+    logger.debug(f"stopped worker {name}")
+
+
+def run_price_worker(name, stop):
+    with requests.Session() as http:
+        run_worker(name, lambda: collect_prices(http), stop)
+
+
+def run_transfer_worker(name, stop):
+    loop = asyncio.new_event_loop()
+    collector = TransferCollector()
+    loop.run_until_complete(collector.open())
+    try:
+        run_worker(name, lambda: loop.run_until_complete(collector.collect()), stop)
+    finally:
+        loop.run_until_complete(collector.close())
+        loop.close()
+
+
+class WorkerPool:
+    """Long-lived ingestion workers that drain the snapshot queues.
+
+    Each price worker keeps its own HTTP session and the transfer worker runs one
+    event loop with `ETHERSCAN_CONCURRENCY` snapshots in flight. Database
+    connections stay warm in the pool of the shared engine.
+    """
+
+    def __init__(self, price_workers=PRICE_WORKERS):
+        self.stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(
+                target=run_price_worker,
+                args=(f"prices-{idx}", self.stop_event),
+                daemon=True,
+            )
+            for idx in range(price_workers)
+        ]
+        self.threads.append(
+            threading.Thread(
+                target=run_transfer_worker,
+                args=("transfers", self.stop_event),
+                daemon=True,
+            )
+        )
+
+    def start(self):
+        logger.info(f"starting {len(self.threads)} ingestion workers")
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        logger.info("stopping ingestion workers")
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()